@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+# Will run in Python 2 or Python 3, some benchmarks need a newer Python 3
+
+#
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import tarfile
+import subprocess
+import argparse
+import logging
+
+# Human readable CWD
+cwd = "./"
+
+logger = logging.getLogger("bench")
+
+#
+# Import Time
+#
+
+# CLI invocations that must stay cheap, since argcomplete runs them on every TAB
+importtime_commands = [["moromi.py", "-h"],
+                       ["toji.py", "-h"]]
+
+# Modules that only subcommands should load
+importtime_forbidden = ["docker", "requests", "toposort", "concurrent.futures"]
+
+# Cumulative import time budget for each command, in microseconds
+importtime_budget_us = 150000
+
+def parse_importtime(output):
+    # Lines look like: "import time:       self [us] |  cumulative | imported package"
+    modules = dict()
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        try:
+            cumulative = int(parts[1].strip())
+        except ValueError:
+            # Header line
+            continue
+        raw_name = parts[2]
+        name = raw_name.strip()
+        depth = (len(raw_name) - len(raw_name.lstrip())) // 2
+        modules[name] = (cumulative, depth)
+    return modules
+
+def measure_importtime(command, repo_dir):
+    argv = [sys.executable, "-X", "importtime", os.path.join(repo_dir, command[0])] + command[1:]
+    proc = subprocess.Popen(argv, cwd=repo_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    if proc.returncode != 0:
+        raise Exception("Command {0} exited with {1}".format(" ".join(command), proc.returncode))
+    modules = parse_importtime(err.decode("utf-8", "replace"))
+    # Top level imports have the smallest indent, their cumulative times cover everything else
+    total = sum(c for c, d in modules.values() if d == 0)
+    return total, modules
+
+def importtime(args):
+    if sys.version_info < (3, 7):
+        logger.error("-X importtime requires Python 3.7 or above")
+        return 2
+
+    over_budget = []
+    for command in importtime_commands:
+        best_total = None
+        modules = None
+        for _ in range(args.repeat):
+            total, mods = measure_importtime(command, args.repo_dir)
+            if best_total is None or total < best_total:
+                best_total, modules = total, mods
+
+        cmd_text = " ".join(command)
+        logger.info("{cmd_text}: {0:.1f} ms cumulative import time".format(best_total / 1000.0, **locals()))
+
+        top = sorted(((c, n) for n, (c, d) in modules.items() if d == 0), reverse=True)[:args.top]
+        for cumulative, name in top:
+            logger.info("    {0:>8.1f} ms  {1}".format(cumulative / 1000.0, name))
+
+        loaded = [m for m in importtime_forbidden if m in modules]
+        if loaded:
+            over_budget.append("{cmd_text} imports {0}".format(", ".join(loaded), **locals()))
+        if best_total > args.budget:
+            over_budget.append("{cmd_text} took {0:.1f} ms, budget is {1:.1f} ms".format(best_total / 1000.0, args.budget / 1000.0, **locals()))
+
+    if over_budget:
+        for problem in over_budget:
+            logger.error(problem)
+        return 1
+
+#
+# Temp Directory Copies
+#
+
+def make_lib_tree(root, files, file_size, fanout=10):
+    data = os.urandom(file_size)
+    for i in range(files):
+        subdir = os.path.join(root, "d{0}".format(i % fanout), "e{0}".format((i // fanout) % fanout))
+        if not os.path.exists(subdir):
+            os.makedirs(subdir)
+        with open(os.path.join(subdir, "f{0}.py".format(i)), "wb") as f:
+            f.write(data)
+
+def tempcopy(args):
+    sys.path.insert(0, args.repo_dir)
+    import nagoya.temp
+
+    source_parent = None
+    if args.source is None:
+        source_parent = tempfile.mkdtemp(prefix="nagoya-bench-", dir=args.source_dir)
+        source = os.path.join(source_parent, "lib")
+        logger.info("Generating {0} files of {1} bytes in {2}".format(args.files, args.file_size, source))
+        make_lib_tree(source, args.files, args.file_size)
+    else:
+        source = args.source
+
+    try:
+        for method in sorted(nagoya.temp.copy_methods):
+            timings = []
+            unsupported = set()
+            for _ in range(args.repeat):
+                temp_dir = nagoya.temp.TempDirectory(dir=args.temp_dir, copy_method=method)
+                try:
+                    start = time.time()
+                    temp_dir.include(source, "/tmp/lib")
+                    timings.append(time.time() - start)
+                    unsupported = temp_dir._unsupported
+                finally:
+                    temp_dir.cleanup()
+            fallbacks = " (unsupported: {0})".format(", ".join(sorted(unsupported))) if unsupported else ""
+            logger.info("{0:>8}: best {1:8.1f} ms, median {2:8.1f} ms{3}".format(method, min(timings) * 1000, sorted(timings)[len(timings) // 2] * 1000, fallbacks))
+    finally:
+        if source_parent is not None:
+            shutil.rmtree(source_parent)
+
+#
+# Persist Compression
+#
+
+persistcodec_codecs = [("none", None), ("gzip", 1), ("gzip", 6), ("gzip", 9), ("xz", 0), ("xz", 6)]
+
+# CPU time of this process, time.clock on Python 2
+cpu_time = getattr(time, "process_time", None) or time.clock
+
+class CountingWriter(object):
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+def make_volume_tree(root, files, file_size, random_fraction, fanout=10):
+    # Database-like files: some incompressible data, the rest repetitive records
+    random_size = int(file_size * random_fraction)
+    record = "".join("row %08d|status=active|owner=kojiadmin|\n" % i for i in range(64)).encode()
+    for i in range(files):
+        subdir = os.path.join(root, "d{0}".format(i % fanout))
+        if not os.path.exists(subdir):
+            os.makedirs(subdir)
+        with open(os.path.join(subdir, "f{0}".format(i)), "wb") as f:
+            f.write(os.urandom(random_size))
+            remaining = file_size - random_size
+            f.write((record * (remaining // len(record) + 1))[:remaining])
+
+def persistcodec(args):
+    sys.path.insert(0, args.repo_dir)
+    import nagoya.dockerext.archive
+
+    work_dir = tempfile.mkdtemp(prefix="nagoya-bench-", dir=args.source_dir)
+    try:
+        if args.source is None:
+            source = os.path.join(work_dir, "volume")
+            logger.info("Generating {0} files of {1} bytes in {2}".format(args.files, args.file_size, source))
+            make_volume_tree(source, args.files, args.file_size, args.random_fraction)
+        else:
+            source = args.source
+
+        tar_path = os.path.join(work_dir, "extract.tar")
+        with tarfile.open(tar_path, "w") as tar:
+            tar.add(source, arcname="volume")
+        tar_size = os.path.getsize(tar_path)
+        logger.info("Archive is {0:.1f} MB uncompressed".format(tar_size / 1e6))
+
+        header = "{0:>10} {1:>10} {2:>7} {3:>10}".format("codec", "size MB", "ratio", "cpu s")
+        header += "".join(" {0:>12}".format("@{0:g} MB/s".format(b)) for b in args.bandwidth)
+        logger.info(header)
+        for codec, level in persistcodec_codecs:
+            name = codec if level is None else "{0}-{1}".format(codec, level)
+            try:
+                nagoya.dockerext.archive.open_compressed(CountingWriter(), codec, level).close()
+            except ValueError as e:
+                logger.info("{name:>10} skipped: {e}".format(**locals()))
+                continue
+
+            best = None
+            for _ in range(args.repeat):
+                counter = CountingWriter()
+                start = cpu_time()
+                with open(tar_path, "rb") as f:
+                    with nagoya.dockerext.archive.open_compressed(counter, codec, level) as out:
+                        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                            out.write(chunk)
+                elapsed = cpu_time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            line = "{0:>10} {1:>10.1f} {2:>7.2f} {3:>10.2f}".format(name, counter.size / 1e6, float(counter.size) / tar_size, best)
+            # Total persist cost: compressing, then uploading the context
+            line += "".join(" {0:>11.2f}s".format(best + counter.size / (b * 1e6)) for b in args.bandwidth)
+            logger.info(line)
+    finally:
+        shutil.rmtree(work_dir)
+
+#
+# Main
+#
+
+def create_argparser():
+    parser = argparse.ArgumentParser(description="Run performance checks against nagoya")
+    parser.add_argument("-d", "--repo-dir", default=cwd, help="Use this directory instead of the working directory")
+    subparsers = parser.add_subparsers()
+
+    it_parser = subparsers.add_parser("importtime", description="Check CLI startup import time against a budget")
+    it_parser.set_defaults(func=importtime)
+    it_parser.add_argument("-b", "--budget", type=int, default=importtime_budget_us, help="Cumulative import time budget in microseconds")
+    it_parser.add_argument("-r", "--repeat", type=int, default=5, help="Take the best of this many runs")
+    it_parser.add_argument("-t", "--top", type=int, default=5, help="Show this many of the slowest top level imports")
+
+    tc_parser = subparsers.add_parser("tempcopy", description="Compare TempDirectory copy methods on a large lib tree")
+    tc_parser.set_defaults(func=tempcopy)
+    tc_parser.add_argument("-s", "--source", help="Copy this directory instead of a generated tree")
+    tc_parser.add_argument("-S", "--source-dir", help="Generate the tree in this directory (default is the system temp dir)")
+    tc_parser.add_argument("-t", "--temp-dir", help="Create the temporary directories in this directory, for example /dev/shm")
+    tc_parser.add_argument("-f", "--files", type=int, default=2000, help="Number of files in the generated tree")
+    tc_parser.add_argument("-z", "--file-size", type=int, default=32 * 1024, help="Size of each generated file in bytes")
+    tc_parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of runs per method")
+
+    pc_parser = subparsers.add_parser("persistcodec", description="Compare persist_compression codecs: compression CPU time against context upload time")
+    pc_parser.set_defaults(func=persistcodec)
+    pc_parser.add_argument("-s", "--source", help="Archive this directory (for example a copy of real volume data) instead of a generated tree")
+    pc_parser.add_argument("-S", "--source-dir", help="Generate the tree and archive in this directory (default is the system temp dir)")
+    pc_parser.add_argument("-f", "--files", type=int, default=1000, help="Number of files in the generated tree")
+    pc_parser.add_argument("-z", "--file-size", type=int, default=64 * 1024, help="Size of each generated file in bytes")
+    pc_parser.add_argument("-R", "--random-fraction", type=float, default=0.2, help="Fraction of each generated file that is incompressible")
+    pc_parser.add_argument("-b", "--bandwidth", type=float, nargs="+", default=[10, 100, 1000], help="Upload bandwidths to the daemon in MB/s to estimate total time for")
+    pc_parser.add_argument("-r", "--repeat", type=int, default=3, help="Take the best of this many runs per codec")
+
+    return parser
+
+if __name__ == "__main__":
+    parser = create_argparser()
+    try:
+        import argcomplete
+        argcomplete.autocomplete(parser)
+    except ImportError:
+        pass
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(name)s %(levelname)s: %(message)s")
+
+    if "func" in args:
+        sys.exit(args.func(args))
+    else:
+        parser.print_help()
@@ -1,15 +1,10 @@
 from __future__ import print_function
 import contextlib
 import os
-import uuid
-import tarfile
-import io
 import logging
 
 import iniparse
 
-import nagoya.dockerext.container
-
 logger = logging.getLogger("kojicallbacks")
 
 #
@@ -34,27 +29,10 @@ def mod_ini(path):
     with open(path, "w") as f:
         print(ini_data, end="", file=f)
 
-# Can't extract a container's volume data with API copy command (yet).
-# Alternative is to use a temp container mounting a host volume
+# Uses the archive API, which can read volume data without a helper container
 def vol_copy(container, container_paths, target_host_dir):
-    client = container.client
-
-    # TODO Might be able to do this easier with docker exec in 1.3.0 ?
-    extract_container = nagoya.dockerext.container.TempContainer("busybox")
-    container_volume_dir = "/" + extract_container.random_name()
-    extract_container.client = client
-    extract_container.add_volume(target_host_dir, container_volume_dir)
-    # TODO ^^^ host volumes working on Fedora depends on Docker#5910
-    extract_container.add_volume_from(container.name, "ro")
-    extract_container.entrypoint = ["cp", "-R"]
-    extract_container.commands = container_paths + [container_volume_dir]
-    if not os.path.exists(target_host_dir):
-        os.makedirs(target_host_dir)
-    try:
-        extract_container.init()
-        extract_container.wait()
-    finally:
-        extract_container.remove()
+    for container_path in container_paths:
+        container.copy_out(container_path, target_host_dir)
 
 def get_network(container):
     return container.client.inspect_container(container.name)["NetworkSettings"]
@@ -90,11 +68,14 @@ def update_config_profile(container):
 
 def extract_credentials(container):
     container_cred_dir = "/etc/pki/koji/"
-    container_user_pem = os.path.join(container_cred_dir, "kojiadmin.pem")
-    container_ca_cert = os.path.join(container_cred_dir, "koji_ca.crt")
-    # TODO enable when working
-    #vol_copy(container, [container_user_pem, container_ca_cert], local_cred_dir)
-    pass
+    cred_files = ["kojiadmin.pem", "koji_ca.crt"]
+    # A module global, format(**locals()) doesn't see it
+    logger.info("Copying credentials from {container} to {local_cred_dir}".format(local_cred_dir=local_cred_dir, **locals()))
+    # One archive of the directory, only the needed files are extracted
+    extracted = container.copy_out(container_cred_dir, local_cred_dir, strip_root=True, members=cred_files)
+    missing = set(cred_files) - set(extracted)
+    if missing:
+        logger.warn("Credential file(s) {0} not found in {container}".format(", ".join(missing), **locals()))
 
 def cleanup_credentials(container):
     pass
@@ -19,52 +19,243 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import docker
+from __future__ import print_function
+import os
+import sys
 
+# Only lightweight modules are imported here, so that help output and argcomplete
+# don't pay for docker/requests. Subcommands import what they need.
 import nagoya.cli.args
 import nagoya.cli.log
 import nagoya.cli.cfg
-import nagoya.dockerext.build
-import nagoya.moromi
+import nagoya.temp
+import nagoya.daemon
 
 default_config_paths = ["cfg/images.cfg"]
-boolean_config_options = ["commit"]
+boolean_config_options = ["commit", "plan_layers", "squash", "persist_delta", "persist_reproducible"]
 
-def sc_all(args):
+# Returns None if the command should be run locally
+def _service_client(args):
+    if args.no_daemon:
+        return None
+    client = nagoya.daemon.Client(args.socket)
+    if not client.available():
+        return None
+    return client
+
+def _config_paths(args):
+    paths = default_config_paths if args.config == [] else args.config
+    return [os.path.abspath(os.path.expanduser(p)) for p in paths]
+
+def _format_job(job):
+    lines = ["Job {0} ({1}, priority {2})".format(job["id"], job["state"], job["priority"])]
+    for task in job["tasks"]:
+        shared = [str(j) for j in task["jobs"] if not j == job["id"]]
+        note = " (shared with job {0})".format(", ".join(shared)) if shared else ""
+        lines.append("  {0}: {1}{2}".format(" + ".join(task["images"]), task["state"], note))
+    if job["error"] is not None:
+        lines.append("  {0}".format(job["error"]))
+    return "\n".join(lines)
+
+def _follow_job(client, job_id, poll_interval=5):
+    print("Submitted job {0} to the build service".format(job_id))
+    reported = dict()
+    try:
+        while True:
+            job = client.request("wait", job=job_id, timeout=poll_interval)["result"]
+            for task in job["tasks"]:
+                name = " + ".join(task["images"])
+                if not reported.get(name) == task["state"]:
+                    reported[name] = task["state"]
+                    print("{0}: {1}".format(name, task["state"]))
+            if job["end"] is not None:
+                break
+    except KeyboardInterrupt:
+        job = client.request("cancel", job=job_id)["result"]
+    print(_format_job(job))
+    return 0 if job["state"] == "done" else 1
+
+def _build_locally(args, config, images, history):
+    if len(args.docker_host) > 1:
+        import nagoya.distribute
+        endpoints = [nagoya.distribute.Endpoint(url, args.builds_per_host) for url in args.docker_host]
+        return nagoya.distribute.build_images(config, args.quiet_build, args.env, images, endpoints, warm_systems=args.warm_systems, share_libs=args.share_libs, prepull=not args.no_pull, history=history)
+
+    import nagoya.moromi
+    base_url = args.docker_host[0] if args.docker_host else None
+    return nagoya.moromi.build_images(config, args.quiet_build, args.env, images, warm_systems=args.warm_systems, share_libs=args.share_libs, prepull=not args.no_pull, pull_workers=args.pull_jobs, max_workers=args.parallel, history=history, base_url=base_url)
+
+def _local_only_options(args):
+    # Options the build service can't apply to one job, it has its own settings for them
+    options = [("--report-json", args.report_json is not None),
+               ("--no-report", args.no_report),
+               ("--parallel", args.parallel != 1),
+               ("--history", args.history is not None),
+               ("--pull-jobs", args.pull_jobs != 4),
+               ("--temp-dir", args.temp_dir is not None),
+               ("--copy-method", args.copy_method is not None)]
+    return [name for name, given in options if given]
+
+def _build(args, images=None):
+    # The build service uses its own Docker daemon
+    client = None if args.docker_host else _service_client(args)
+    local_only = _local_only_options(args)
+    if client is not None and len(local_only) > 0:
+        print("Building locally, the build service doesn't take {0}".format(", ".join(local_only)), file=sys.stderr)
+        client = None
+    if client is not None:
+        job_id = client.request("submit", config=_config_paths(args), images=images, env=args.env, warm_systems=args.warm_systems, share_libs=args.share_libs, quiet=args.quiet_build, prepull=not args.no_pull, priority=args.priority)["result"]
+        return _follow_job(client, job_id)
+
+    import nagoya.dockerext.build
+    import nagoya.schedule
     config, _ = nagoya.cli.cfg.read_config(args.config, default_config_paths, boolean_config_options)
-    return nagoya.moromi.build_images(config, args.quiet_build, args.env)
+    history = nagoya.schedule.BuildHistory(args.history)
+    with nagoya.temp.TempArena():
+        with nagoya.dockerext.build.BuildReport() as report:
+            try:
+                return _build_locally(args, config, images, history)
+            finally:
+                # Durations of the builds that succeeded, even if the run failed
+                history.save()
+                if report.builds and not args.no_report:
+                    print(report.format_table())
+                if args.report_json is not None:
+                    report.write_json(args.report_json)
 
-def scargs_all(parser):
-    parser.description = "Build all images in the configuration, automatically resolving dependency order."
+def _add_build_args(parser):
     parser.add_argument("-b", "--quiet-build", action="store_true", help="Do not print the builds' stdout/stderr")
     parser.add_argument("-e", "--env", metavar="K=V", action="append", default=[], help="Set a variable in the builds' environment")
+    parser.add_argument("-w", "--warm-systems", action="store_true", help="Share one running container system between consecutive builds using the same system file")
+    parser.add_argument("-l", "--share-libs", action="store_true", help="Build libs common to standard images with the same from image into one base image, and build those images on it")
+    parser.add_argument("-P", "--no-pull", action="store_true", help="Do not pull missing base images before building, leave it to the builds")
+    parser.add_argument("-J", "--pull-jobs", type=nagoya.cli.args.positive_int, default=4, help="Number of images to pull at once")
+    parser.add_argument("-R", "--no-report", action="store_true", help="Do not print the step timing and cache summary at the end")
+    parser.add_argument("-j", "--report-json", metavar="FILE", help="Write per-step build timings and cache hits to this file as JSON")
+    parser.add_argument("-p", "--parallel", metavar="N", type=nagoya.cli.args.positive_int, default=1, help="Build up to N images at once, those with the longest chain of builds after them first. Consider --quiet-build, since build output is interleaved.")
+    parser.add_argument("-d", "--docker-host", metavar="URL", action="append", default=[], help="Build on the Docker daemon at this URL, for example unix:///var/run/docker.sock or tcp://host:2375. When given more than once, builds are spread over the daemons, and every built image ends up on the first one.")
+    parser.add_argument("-B", "--builds-per-host", metavar="N", type=nagoya.cli.args.positive_int, default=1, help="With several --docker-host, build up to N images at once on each")
+    parser.add_argument("-r", "--priority", type=int, default=0, help="When sent to the build service, start this job's builds before those of jobs with a lower priority")
+    _add_history_arg(parser)
+
+def _add_history_arg(parser):
+    parser.add_argument("-H", "--history", metavar="FILE", help="Record and read image build durations in this file instead of ~/.cache/nagoya/build-history.json")
+
+def sc_all(args):
+    return _build(args)
+
+def scargs_all(parser):
+    parser.description = "Build all images in the configuration, automatically resolving dependency order."
+    _add_build_args(parser)
 
 def sc_build(args):
-    config, _ = nagoya.cli.cfg.read_config(args.config, default_config_paths, boolean_config_options)
-    return nagoya.moromi.build_images(config, args.quiet_build, args.env, args.images)
+    return _build(args, args.images)
 
 def scargs_build(parser):
     parser.description = "Build images from the configuration in the specified order."
-    parser.add_argument("-b", "--quiet-build", action="store_true", help="Do not print the builds' stdout/stderr")
-    parser.add_argument("-e", "--env", metavar="K=V", action="append", default=[], help="Set a variable in the builds' environment")
+    _add_build_args(parser)
     imgs = parser.add_argument("images", metavar="IMAGE", nargs="+", help="Image to build")
     if nagoya.cli.args.argcomplete_available:
         imgs.completer = nagoya.cli.args.ConfigSectionsCompleter(default_config_paths)
 
-def sc_clean(args):
+def sc_size(args):
+    import nagoya.moromi
+    config, _ = nagoya.cli.cfg.read_config(args.config, default_config_paths, boolean_config_options)
+    names = args.images if len(args.images) > 0 else None
+    return 1 if nagoya.moromi.show_image_sizes(config, names) > 0 else 0
+
+def scargs_size(parser):
+    parser.description = "Show how much each layer of the built images adds, and what produced it"
+    imgs = parser.add_argument("images", metavar="IMAGE", nargs="*", help="Section or image to analyse (default is all)")
+    if nagoya.cli.args.argcomplete_available:
+        imgs.completer = nagoya.cli.args.ConfigSectionsCompleter(default_config_paths)
+
+def sc_plan(args):
+    import nagoya.moromi
+    config, _ = nagoya.cli.cfg.read_config(args.config, default_config_paths, boolean_config_options)
+    names = args.images if len(args.images) > 0 else None
+    nagoya.moromi.show_plan(config, names, args.warm_systems, args.parallel, args.history)
+
+def scargs_plan(parser):
+    parser.description = "Predict how long building images in parallel takes, from the durations of earlier builds, and show the critical chain of builds"
+    parser.add_argument("-p", "--parallel", metavar="N", type=nagoya.cli.args.positive_int, default=4, help="Number of images built at once")
+    parser.add_argument("-w", "--warm-systems", action="store_true", help="Plan for --warm-systems builds")
+    _add_history_arg(parser)
+    imgs = parser.add_argument("images", metavar="IMAGE", nargs="*", help="Image to build (default is all)")
+    if nagoya.cli.args.argcomplete_available:
+        imgs.completer = nagoya.cli.args.ConfigSectionsCompleter(default_config_paths)
+
+def sc_serve(args):
+    import nagoya.moromid
+    socket_mode = 0o660 if args.group_access else 0o600
+    server = nagoya.moromid.BuildService(args.socket, boolean_config_options, args.parallel, args.history, socket_mode)
+    server.serve()
+
+def scargs_serve(parser):
+    parser.description = "Serve builds from a long-running process. While it is running, build and all commands are sent to it, and identical builds requested at the same time are only run once."
+    parser.add_argument("-p", "--parallel", metavar="N", type=nagoya.cli.args.positive_int, default=2, help="Number of images built at once")
+    parser.add_argument("-g", "--group-access", action="store_true", help="Let members of the socket's group submit builds too. Give a --socket path they can all reach, since the default one is per user.")
+    _add_history_arg(parser)
+
+def _require_service(args):
+    client = _service_client(args)
+    if client is None:
+        print("No build service is listening on {0}".format(args.socket), file=sys.stderr)
+    return client
+
+def sc_jobs(args):
+    client = _require_service(args)
+    if client is None:
+        return 1
+    for job in client.request("status", job=args.job)["result"]:
+        print(_format_job(job))
+
+def scargs_jobs(parser):
+    parser.description = "Show the jobs of the build service and the state of their builds"
+    parser.add_argument("job", metavar="JOB", type=int, nargs="?", help="Only show this job")
+
+def sc_cancel(args):
+    client = _require_service(args)
+    if client is None:
+        return 1
+    print(_format_job(client.request("cancel", job=args.job)["result"]))
+
+def scargs_cancel(parser):
+    parser.description = "Cancel a job of the build service. Its queued builds that no other job needs are dropped, running builds finish."
+    parser.add_argument("job", metavar="JOB", type=int, help="Job to cancel")
+
+def _clean_images(max_workers):
+    import docker
+    import nagoya.dockerext.image
     c = docker.Client()
-    nagoya.dockerext.build.clean_untagged_images(c)
+    nagoya.dockerext.image.clean_untagged_images(c, max_workers)
+
+def sc_clean(args):
+    if args.temp:
+        nagoya.temp.sweep()
+    else:
+        _clean_images(args.jobs)
 
 def scargs_clean(parser):
     parser.description = "Remove all untagged local images"
+    parser.add_argument("-j", "--jobs", type=nagoya.cli.args.positive_int, default=8, help="Number of images to remove at once")
+    parser.add_argument("-T", "--temp", action="store_true", help="Instead, remove temporary directories left behind by moromi runs that are no longer alive")
 
 if __name__ == "__main__":
     parser = nagoya.cli.args.create_default_argument_parser(description="Work with docker images")
+    parser.add_argument("-t", "--temp-dir", help="Create build contexts and other temporary directories in this directory, for example /dev/shm")
+    parser.add_argument("-s", "--socket", default=nagoya.daemon.default_socket_path("moromi"), help="Unix socket of the build service")
+    parser.add_argument("-D", "--no-daemon", action="store_true", help="Don't send builds to a running build service")
+    parser.add_argument("-m", "--copy-method", choices=sorted(nagoya.temp.copy_methods), help="How to put files into build contexts (default {0}). hardlink and reflink fall back to copy when the filesystems don't support them, auto tries reflink then hardlink.".format(nagoya.temp.default_copy_method))
     nagoya.cli.args.add_subcommand_subparsers(parser)
     nagoya.cli.args.attempt_autocomplete(parser)
     args = parser.parse_args()
 
     nagoya.cli.log.setup_logger(args.quiet, args.verbose)
 
+    nagoya.temp.default_dir = args.temp_dir
+    if args.copy_method is not None:
+        nagoya.temp.default_copy_method = args.copy_method
+
     nagoya.cli.args.run_subcommand_func(args, parser)
 
@@ -21,29 +21,140 @@ import collections
 
 import nagoya.toji
 import nagoya.temp
+import nagoya.persist
+import nagoya.dockerext.archive
+import nagoya.dockerext.build
 import nagoya.dockerext.container
+import nagoya.dockerext.image
 
 logger = logging.getLogger("nagoya.build")
 
 ContainerAndDest = collections.namedtuple("ContainerAndDest", ["container", "dest_image"])
 
+#
+# Image production
+#
+
+# Used to extract the volumes of persisted containers
+persist_helper_image = "busybox"
+
+def commit_container(client, container, image):
+    logger.info("Commiting {container} container to image {image}".format(**locals()))
+    client.commit(container.name, image)
+    if nagoya.dockerext.image.active_index is not None:
+        nagoya.dockerext.image.active_index.record_tagged(image)
+
+def persist_container(client, container, image, quiet, **options):
+    # The archive based persist supports the options, busybox tar doesn't
+    if any(options.values()):
+        nagoya.persist.persist_container(client, container, image, quiet, **options)
+        return
+
+    logger.info("Persisting {container} container to image {image}".format(**locals()))
+
+    with nagoya.temp.TempDirectory() as tdir:
+        source_volumes = client.inspect_container(container=container.name)["Volumes"]
+        # busybox's tar won't accept file/dir arguments with a starting slash
+        volume_paths = [v.lstrip("/") for v in source_volumes.keys()]
+
+        logger.debug("Extracting files from {container} volumes".format(**locals()))
+        container_volume_dir = os.path.join("/", container.random_name())
+        container_tar_path = os.path.join(container_volume_dir, "extract.tar")
+        host_tar_path = os.path.join(tdir.name, "extract.tar")
+
+        with nagoya.dockerext.container.TempContainer(persist_helper_image) as extract_container:
+            extract_container.client = client
+            extract_container.add_volume(tdir.name, container_volume_dir)
+            # TODO ^^^ host volumes working on Fedora depends on Docker#5910
+            extract_container.add_volume_from(container.name, "ro")
+            extract_container.entrypoint = ["tar", "-cf", container_tar_path]
+            extract_container.commands = volume_paths
+            extract_container.init()
+            extract_container.wait(error_ok=False)
+
+        logger.info("Building image {image} with volume data from {container} container".format(**locals()))
+        with nagoya.dockerext.build.BuildContext(image, container.image, client, quiet) as context:
+            context.include(host_tar_path, "/", context_rel_path="extract.tar")
+
+class VolumeIncludes(object):
+    """
+    Host files to be made available in containers, through temporary host
+    volumes.
+    """
+
+    def __init__(self):
+        self.temp_vol_dirs = dict()
+
+    def include(self, container, src_path, container_path, executable=False):
+        container_dir = os.path.dirname(container_path)
+
+        if not container in self.temp_vol_dirs:
+            self.temp_vol_dirs[container] = dict()
+        if not container_dir in self.temp_vol_dirs[container]:
+            # Mounted read-write, so the container can't change the source files
+            vd = nagoya.temp.TempDirectory(allow_hardlinks=False)
+            container.add_volume(vd.name, container_dir)
+            # TODO ^^^ host volumes working on Fedora depends on Docker#5910
+            self.temp_vol_dirs[container][container_dir] = vd
+
+        dest_basename = os.path.basename(container_path)
+        self.temp_vol_dirs[container][container_dir].include(src_path, dest_basename, executable)
+
+    def cleanup(self):
+        for temp_dirs in self.temp_vol_dirs.values():
+            for temp_dir in temp_dirs.values():
+                temp_dir.cleanup()
+
+class ArchiveIncludes(object):
+    """
+    Host files to be uploaded into containers after they are created, as
+    in-memory tar archives. Doesn't need any temporary host directories.
+    """
+
+    def __init__(self):
+        self.archives = dict()
+
+    def include(self, container, src_path, container_path, executable=False):
+        if not container in self.archives:
+            archive = nagoya.dockerext.archive.MemoryArchive()
+            container.callbacks.append(nagoya.dockerext.container.Callspec("post", "create", archive.put))
+            self.archives[container] = archive
+
+        self.archives[container].add(src_path, container_path, executable)
+
+    def cleanup(self):
+        self.archives.clear()
+
+include_methods = {"volume": VolumeIncludes,
+                   "archive": ArchiveIncludes}
+
+def create_includes(include_method):
+    if not include_method in include_methods:
+        raise ValueError("Include method '{0}' is not one of {1}".format(include_method, ", ".join(sorted(include_methods))))
+    return include_methods[include_method]()
+
+#
+# Container systems
+#
+
 class BuildContainerSystem(nagoya.toji.TempToji):
     """
     Succinctly construct a system of containers and produce images from them in
     multiple ways.
     """
 
-    def __init__(self, containers=None, client=None, cleanup=None, quiet=False):
+    def __init__(self, containers=None, client=None, cleanup=None, quiet=False, include_method="volume"):
         super(BuildContainerSystem, self).__init__(containers=containers, client=client, cleanup=cleanup)
         self.to_commit = []
         self.to_persist = []
-        self.temp_vol_dirs = dict()
+        self.includes = create_includes(include_method)
         self.quiet = quiet
+        self.root_timeout = None
+        # Keyword arguments for persist_container
+        self.persist_options = dict()
 
     def root_name(self, container_name):
-        self.root = next((c for c in self.containers if c.name == container_name), "None")
-        if self.root is None:
-            raise KeyError(container_name)
+        self.root = self._lookup_container(container_name)
 
     def _lookup_container(self, container_name):
         for container in self.containers:
@@ -58,60 +169,27 @@ class BuildContainerSystem(nagoya.toji.TempToji):
         self.to_persist.append(ContainerAndDest(self._lookup_container(container_name), dest_image))
 
     def volume_include(self, container, src_path, container_path, executable=False):
-        container_dir = os.path.dirname(container_path)
-
-        if not container in self.temp_vol_dirs:
-            self.temp_vol_dirs[container] = dict()
-        if not container_dir in self.temp_vol_dirs[container]:
-            vd = nagoya.temp.TempDirectory()
-            container.add_volume(vd.name, container_dir)
-            # TODO ^^^ host volumes working on Fedora depends on Docker#5910
-            self.temp_vol_dirs[container][container_dir] = vd
-
-        dest_basename = os.path.basename(container_path)
-        self.temp_vol_dirs[container][container_dir].include(src_path, dest_basename, executable)
+        self.includes.include(container, src_path, container_path, executable)
 
     def _run(self):
+        # The root is waited on below, with its output streamed
+        self.root.detach = True
+
         logger.info("Starting temporary container system")
         self.init_containers()
 
         logger.info("Waiting for the root container to finish")
-        self.root.wait(error_ok=False)
+        self.root.watch(quiet=self.quiet, timeout=self.root_timeout)
 
         logger.info("Stopping temporary container system")
         self.stop_containers()
 
     def _build(self):
         for container, image in self.to_commit:
-            logger.info("Commiting {container} container to image {image}".format(**locals()))
-            self.client.commit(container.name, image)
+            commit_container(self.client, container, image)
 
         for container, image in self.to_persist:
-            logger.info("Persisting {container} container to image {image}".format(**locals()))
-
-            with nagoya.temp.TempDirectory() as tdir:
-                source_volumes = self.client.inspect_container(container=container.name)["Volumes"]
-                # busybox's tar won't accept file/dir arguments with a starting slash
-                volume_paths = [v.lstrip("/") for v in source_volumes.keys()]
-
-                logger.debug("Extracting files from {container} volumes".format(**locals()))
-                container_volume_dir = os.path.join("/", container.random_name())
-                container_tar_path = os.path.join(container_volume_dir, "extract.tar")
-                host_tar_path = os.path.join(tdir.name, "extract.tar")
-
-                with nagoya.dockerext.container.TempContainer("busybox") as extract_container:
-                    extract_container.client = self.client
-                    extract_container.add_volume(tdir.name, container_volume_dir)
-                    # TODO ^^^ host volumes working on Fedora depends on Docker#5910
-                    extract_container.add_volume_from(container.name, "ro")
-                    extract_container.entrypoint = ["tar", "-cf", container_tar_path]
-                    extract_container.commands = volume_paths
-                    extract_container.init()
-                    extract_container.wait(error_ok=False)
-
-                logger.info("Building image {image} with volume data from {container} container".format(**locals()))
-                with nagoya.dockerext.build.BuildContext(image, container.image, self.client, self.quiet) as context:
-                    context.include(host_tar_path, "/", context_rel_path="extract.tar")
+            persist_container(self.client, container, image, self.quiet, **self.persist_options)
 
     def __exit__(self, exc, value, tb):
         try:
@@ -122,9 +200,7 @@ class BuildContainerSystem(nagoya.toji.TempToji):
                 logger.error("Exception raised during build container run, running cleanup before raising")
                 raise
             finally:
-                for temp_dirs in self.temp_vol_dirs.values():
-                    for temp_dir in temp_dirs.values():
-                        temp_dir.cleanup()
+                self.includes.cleanup()
             try:
                 if exc is None:
                     self._build()
@@ -133,3 +209,120 @@ class BuildContainerSystem(nagoya.toji.TempToji):
                 raise
         finally:
             super(BuildContainerSystem, self).__exit__(exc, value, tb)
+
+class WarmBuildContainerSystem(nagoya.toji.TempToji):
+    """
+    Keeps a system of containers running while a series of root containers are
+    run against it, one per stage. Each stage can commit/persist containers,
+    which briefly stops the system. Use with "with ... as" blocks.
+    """
+
+    def __init__(self, system_config, root_names, client=None, quiet=False):
+        self.system_config = system_config
+        self.root_names = set(root_names)
+        self.quiet = quiet
+        containers = [nagoya.dockerext.container.Container.from_dict(name, sub)
+                      for name, sub in system_config.items() if not name in self.root_names]
+        for container in containers:
+            dependent_roots = container.dependency_names() & self.root_names
+            if dependent_roots:
+                raise ValueError("Container {0} depends on root container(s) {1}".format(container, ", ".join(dependent_roots)))
+        super(WarmBuildContainerSystem, self).__init__(containers=containers, client=client, cleanup="remove")
+        for container in self.containers:
+            container.client = self.client
+        self.started = False
+
+    def stage(self, root_name, include_method="volume"):
+        if not root_name in self.root_names:
+            raise KeyError(root_name)
+        # A new root container object each time, so per-stage entrypoints and volumes don't accumulate
+        root = nagoya.dockerext.container.Container.from_dict(root_name, self.system_config[root_name])
+        root.client = self.client
+        return BuildStage(self, root, include_method)
+
+    def ensure_started(self):
+        if not self.started:
+            logger.info("Starting warm container system")
+            self.init_containers()
+            self.started = True
+
+    def ensure_stopped(self):
+        if self.started:
+            logger.info("Stopping warm container system")
+            self.stop_containers()
+            self.started = False
+
+class BuildStage(object):
+    """
+    One root container run against a WarmBuildContainerSystem, with the same
+    interface as BuildContainerSystem. Runs when leaving the "with" block if no
+    exception is raised.
+    """
+
+    def __init__(self, system, root, include_method="volume"):
+        self.system = system
+        self.root = root
+        self.to_commit = []
+        self.to_persist = []
+        self.includes = create_includes(include_method)
+        self.root_timeout = None
+        # Keyword arguments for persist_container
+        self.persist_options = dict()
+
+    def _lookup_container(self, container_name):
+        if container_name == self.root.name:
+            return self.root
+        for container in self.system.containers:
+            if container.name == container_name:
+                return container
+        raise KeyError(container_name)
+
+    def commit(self, container_name, dest_image):
+        self.to_commit.append(ContainerAndDest(self._lookup_container(container_name), dest_image))
+
+    def persist(self, container_name, dest_image):
+        self.to_persist.append(ContainerAndDest(self._lookup_container(container_name), dest_image))
+
+    def volume_include(self, container, src_path, container_path, executable=False):
+        self.includes.include(container, src_path, container_path, executable)
+
+    def _run(self):
+        self.system.ensure_started()
+
+        logger.info("Running root container {0}".format(self.root))
+        # The root is waited on below, with its output streamed
+        self.root.detach = True
+        self.root.init()
+        self.root.watch(quiet=self.system.quiet, timeout=self.root_timeout)
+
+    def _build(self):
+        client = self.system.client
+
+        # Only the root needs to be stopped to commit it, anything else needs a consistent system
+        if any(not c is self.root for c, _ in self.to_commit + self.to_persist):
+            self.system.ensure_stopped()
+
+        for container, image in self.to_commit:
+            commit_container(client, container, image)
+
+        for container, image in self.to_persist:
+            persist_container(client, container, image, self.system.quiet, **self.persist_options)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, tb):
+        try:
+            try:
+                if exc is None:
+                    self._run()
+            except Exception as e:
+                logger.error("Exception raised during build container run, running cleanup before raising")
+                raise
+            finally:
+                self.root.stop()
+                self.includes.cleanup()
+            if exc is None:
+                self._build()
+        finally:
+            self.root.remove()
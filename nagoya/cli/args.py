@@ -76,6 +76,16 @@ def add_subcommand_subparsers(root_parser, module_name="__main__"):
             parser_config_function = main_attributes[config_function_name]
             parser_config_function(parser)
 
+def positive_int(value):
+    """
+    Argument type for counts that must be at least 1
+    """
+
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, not {0}".format(value))
+    return number
+
 def create_default_argument_parser(with_config=True, **kwargs):
     parser = argparse.ArgumentParser(**kwargs)
     parser.add_argument("-v", "--verbose", action="count", default=0, help="Make logging more verbose (repeatable)")
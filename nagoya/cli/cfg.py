@@ -16,6 +16,7 @@
 #
 
 import os
+import sys
 import collections
 try:
     import ConfigParser as configparser
@@ -64,3 +65,10 @@ def read_config(paths, default_paths, boolean_options=[]):
         successful_paths.append(path)
 
     return (dictionary, successful_paths)
+
+# So any local callback modules referenced in the cfg can be loaded
+def add_cfg_dirs_to_path(cfg_paths):
+    for cfg_path in cfg_paths:
+        cfg_dir = os.path.dirname(cfg_path)
+        if not cfg_dir in sys.path:
+            sys.path.append(cfg_dir)
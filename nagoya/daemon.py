@@ -0,0 +1,191 @@
+#
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Only standard library imports here, the client side is used by the CLIs before
+# any heavy modules are loaded
+
+import logging
+import os
+import sys
+import json
+import socket
+import signal
+import tempfile
+import traceback
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+logger = logging.getLogger("nagoya.daemon")
+
+#
+# Exceptions
+#
+
+class DaemonRunning(Exception):
+    pass
+
+class RemoteError(Exception):
+    """
+    An exception raised by the daemon while handling a request
+    """
+
+    def __init__(self, message, remote_traceback=None):
+        self.remote_traceback = remote_traceback
+        super(RemoteError, self).__init__(message)
+
+class UnknownRequest(Exception):
+    pass
+
+#
+# Protocol
+#
+
+# One JSON object per line in each direction. Requests have a "command" key and
+# any parameters, responses have either a "result" or an "error" key.
+
+def default_socket_path(name):
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", tempfile.gettempdir())
+    return os.path.join(runtime_dir, "nagoya-{0}-{1}.sock".format(name, os.getuid()))
+
+def send_message(wfile, message):
+    wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+    wfile.flush()
+
+def recv_message(rfile):
+    line = rfile.readline()
+    if not line:
+        return None
+    return json.loads(line.decode("utf-8"))
+
+#
+# Client
+#
+
+class Client(object):
+    """
+    Sends requests to a daemon listening on a unix socket
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def available(self):
+        if not os.path.exists(self.socket_path):
+            return False
+        try:
+            self._connect().close()
+            return True
+        except socket.error as e:
+            logger.debug("Daemon socket {0} is not accepting connections: {1}".format(self.socket_path, e))
+            return False
+
+    def request(self, command, **params):
+        message = dict(params)
+        message["command"] = command
+
+        sock = self._connect()
+        try:
+            rfile = sock.makefile("rb")
+            wfile = sock.makefile("wb")
+            logger.debug("Sending {command} request to {0}".format(self.socket_path, **locals()))
+            send_message(wfile, message)
+            response = recv_message(rfile)
+        finally:
+            sock.close()
+
+        if response is None:
+            raise RemoteError("Daemon closed the connection without responding")
+        if "error" in response:
+            raise RemoteError(response["error"], response.get("traceback"))
+        return response
+
+#
+# Server
+#
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = recv_message(self.rfile)
+            except ValueError as e:
+                send_message(self.wfile, {"error": "Invalid request: {0}".format(e)})
+                return
+            if request is None:
+                return
+            send_message(self.wfile, self.server.dispatch(request))
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves requests on a unix socket, one thread per connection. Subclasses
+    handle commands by defining methods named with the request function prefix.
+    """
+
+    request_func_prefix = "rq_"
+    daemon_threads = True
+
+    def __init__(self, socket_path, socket_mode=0o600):
+        if os.path.exists(socket_path):
+            if Client(socket_path).available():
+                raise DaemonRunning("A daemon is already listening on {0}".format(socket_path))
+            logger.debug("Removing stale socket {0}".format(socket_path))
+            os.remove(socket_path)
+
+        self.socket_path = socket_path
+        socketserver.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+        os.chmod(socket_path, socket_mode)
+
+    def dispatch(self, request):
+        command = request.pop("command", None)
+        func = getattr(self, self.request_func_prefix + str(command), None)
+        try:
+            if func is None:
+                raise UnknownRequest("Unknown command '{0}'".format(command))
+            logger.debug("Handling {command} request".format(**locals()))
+            return {"result": func(**request)}
+        except Exception as e:
+            logger.error("Error while handling {command} request: {e}".format(**locals()))
+            return {"error": str(e), "traceback": traceback.format_exc()}
+
+    def serve(self):
+        def terminate(signum, frame):
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, terminate)
+
+        logger.info("Listening on {0}".format(self.socket_path))
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logger.info("Shutting down")
+            self.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
@@ -0,0 +1,234 @@
+#
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Building the images of one run on several Docker daemons
+
+import logging
+import threading
+
+import docker
+
+import nagoya.moromi
+import nagoya.schedule
+import nagoya.dockerext.image
+
+logger = logging.getLogger("nagoya.distribute")
+
+class Endpoint(object):
+    """
+    A Docker daemon that builds can be placed on, running up to capacity
+    builds at once.
+    """
+
+    def __init__(self, url, capacity=1):
+        self.url = url
+        self.capacity = capacity
+        self.client = docker.Client(base_url=url, timeout=10)
+        self.running = 0
+        # Normalized image names this run built or sent here
+        self.current = set()
+        # Normalized image name -> whether it existed here when first checked
+        self.known = dict()
+        self.known_lock = threading.Lock()
+        # Images are sent here one at a time, so none is sent twice
+        self.provide_lock = threading.Lock()
+
+    def __repr__(self):
+        return "<{0} {1!r}>".format(self.__class__.__name__, self.url)
+
+    def has_image(self, image_name):
+        with self.known_lock:
+            if image_name in self.known:
+                return self.known[image_name]
+        exists = nagoya.dockerext.image.image_exists(self.client, image_name)
+        with self.known_lock:
+            self.known[image_name] = exists
+        return exists
+
+    def load(self):
+        return float(self.running) / self.capacity
+
+class Distributor(object):
+    """
+    Places builds on endpoints and gets the images they need there. The first
+    endpoint is home: at the end of the run it has every image the run built,
+    with the same IDs as where they were built.
+    """
+
+    def __init__(self, endpoints, prepull=True):
+        self.endpoints = endpoints
+        self.home = endpoints[0]
+        self.prepull = prepull
+        self.lock = threading.Lock()
+        # Normalized image name -> endpoint that built it in this run
+        self.built = dict()
+
+    @property
+    def capacity(self):
+        return sum(e.capacity for e in self.endpoints)
+
+    def _has(self, endpoint, image_name):
+        # Images of this run only count in their new version. Other images
+        # may be looked up on the daemon, so this isn't called with the lock.
+        with self.lock:
+            if image_name in self.built:
+                return image_name in endpoint.current
+        return endpoint.has_image(image_name)
+
+    def place(self, required, outputs):
+        """
+        Pick the endpoint for a build that uses the required images and
+        produces the outputs, and count the build as running there. Endpoints
+        that already have the required images come first, then those with an
+        earlier version of the outputs for the layer cache, then the least
+        loaded.
+        """
+
+        required = [nagoya.dockerext.image.normalize_name(n) for n in required]
+        outputs = [nagoya.dockerext.image.normalize_name(n) for n in outputs]
+        # Checked before taking the lock, so other placements don't wait on daemon lookups
+        presence = dict()
+        for endpoint in self.endpoints:
+            missing = len([n for n in required if not self._has(endpoint, n)])
+            cached = len([n for n in outputs if endpoint.has_image(n)])
+            presence[endpoint.url] = (missing, -cached)
+
+        with self.lock:
+            free = [(i, e) for i, e in enumerate(self.endpoints) if e.running < e.capacity]
+            def score(indexed):
+                i, endpoint = indexed
+                return presence[endpoint.url] + (endpoint.load(), i)
+            _, endpoint = min(free, key=score)
+            endpoint.running += 1
+            return endpoint
+
+    def release(self, endpoint):
+        with self.lock:
+            endpoint.running -= 1
+
+    def _source(self, image_name, exclude):
+        with self.lock:
+            if image_name in self.built:
+                return self.built[image_name]
+        for endpoint in self.endpoints:
+            if not endpoint is exclude and endpoint.has_image(image_name):
+                return endpoint
+        return None
+
+    def provide(self, endpoint, required):
+        """
+        Get the required images onto an endpoint: images this run built
+        elsewhere and images only another endpoint has are transferred, the
+        rest are pulled.
+        """
+
+        with endpoint.provide_lock:
+            for image_name in (nagoya.dockerext.image.normalize_name(n) for n in required):
+                if self._has(endpoint, image_name):
+                    continue
+
+                source = self._source(image_name, endpoint)
+                if source is not None:
+                    nagoya.dockerext.image.transfer_image(source.client, endpoint.client, image_name)
+                elif self.prepull:
+                    logger.info("Pulling {image_name} on {endpoint.url}".format(**locals()))
+                    nagoya.dockerext.image.pull_image(endpoint.client, image_name)
+                else:
+                    # Left to the build, like a local run without pulling
+                    continue
+
+                with self.lock:
+                    endpoint.current.add(image_name)
+                with endpoint.known_lock:
+                    endpoint.known[image_name] = True
+
+    def record_built(self, endpoint, outputs):
+        with self.lock:
+            for image_name in (nagoya.dockerext.image.normalize_name(n) for n in outputs):
+                self.built[image_name] = endpoint
+                for other in self.endpoints:
+                    other.current.discard(image_name)
+                endpoint.current.add(image_name)
+            with endpoint.known_lock:
+                endpoint.known.update((nagoya.dockerext.image.normalize_name(n), True) for n in outputs)
+
+    def sync(self):
+        """
+        Make the tags of the images this run built consistent: home gets every
+        one, and other endpoints with an older image under the same tag have
+        that tag removed. Untagged layers stay, for the build cache.
+        """
+
+        for image_name, source in sorted(self.built.items(), key=lambda i: i[0]):
+            built_id = nagoya.dockerext.image.image_id(source.client, image_name)
+            for endpoint in self.endpoints:
+                if endpoint is source:
+                    continue
+                current_id = nagoya.dockerext.image.image_id(endpoint.client, image_name)
+                if current_id == built_id:
+                    continue
+                if endpoint is self.home:
+                    nagoya.dockerext.image.transfer_image(source.client, endpoint.client, image_name)
+                elif current_id is not None:
+                    logger.info("Removing outdated tag {image_name} from {endpoint.url}".format(**locals()))
+                    endpoint.client.remove_image(image_name, noprune=True)
+
+def build_images(config, quiet, env, images, endpoints, warm_systems=False, share_libs=False, prepull=True, history=None):
+    """
+    Like nagoya.moromi.build_images, but with builds spread over several
+    endpoints, as many at once as their capacities add up to, scheduled by
+    critical path.
+    """
+
+    if images is None:
+        logger.info("Resolving image dependency order")
+        images = nagoya.moromi.resolve_dep_order(config)
+
+    num_img = len(images)
+    logger.info("Building {0} image{1} on {2} Docker daemons".format(num_img, "s" if num_img > 1 else "", len(endpoints)))
+    for endpoint in endpoints:
+        endpoint.client.ping()
+
+    distributor = Distributor(endpoints, prepull)
+    shared_bases = nagoya.moromi.plan_shared_bases(config, images) if share_libs else dict()
+    # Separate builders, so each endpoint builds the shared bases it needs itself
+    builders = dict((e.url, nagoya.moromi.ImageBuilder(config, e.client, quiet, env, shared_bases, history)) for e in endpoints)
+
+    scheduling_history = nagoya.schedule.BuildHistory() if history is None else history
+    build_plan = nagoya.moromi.plan_builds(config, images, warm_systems, distributor.capacity, scheduling_history)
+    chain = " -> ".join(build_plan.plan.chain)
+    logger.info("Predicted makespan {0:.1f}s, critical chain {chain}".format(build_plan.plan.makespan, **locals()))
+    groups_by_name = dict((g[0], g) for g in build_plan.groups)
+
+    def build_group(name):
+        group = groups_by_name[name]
+        required = sorted(set(r for image in group for r in nagoya.moromi.required_images(config[image])))
+        outputs = [p[0] for image in group for p in nagoya.moromi.produced_images(image, config[image])]
+        endpoint = distributor.place(required, outputs)
+        try:
+            logger.info("Building {0} on {1}".format(" + ".join(group), endpoint.url))
+            distributor.provide(endpoint, required)
+            builders[endpoint.url].build_group(group)
+            distributor.record_built(endpoint, outputs)
+        finally:
+            distributor.release(endpoint)
+
+    nagoya.schedule.run_scheduled(build_plan.deps, build_plan.plan.paths, build_group, distributor.capacity, build_plan.resources)
+
+    logger.info("Making tags of the built images consistent across daemons")
+    distributor.sync()
+    logger.info("Done")
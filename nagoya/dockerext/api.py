@@ -0,0 +1,69 @@
+#
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import codecs
+
+# Helpers for Docker API endpoints that docker-py doesn't wrap yet, and their responses
+
+def versioned_url(client, version, path):
+    """
+    Like the client's _url, but with a specific API version, for endpoints
+    newer than the client's default version.
+    """
+
+    return "{0}/v{1}{2}".format(client.base_url, version, path)
+
+class JSONStreamDecoder(object):
+    """
+    Decodes JSON objects from a stream of chunks, where objects can be split
+    across chunks or several can be in one chunk.
+    """
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.buffer = ""
+
+    def feed(self, chunk):
+        if isinstance(chunk, bytes):
+            chunk = self.text_decoder.decode(chunk)
+        self.buffer += chunk
+
+        pos = 0
+        length = len(self.buffer)
+        while True:
+            while pos < length and self.buffer[pos].isspace():
+                pos += 1
+            if pos == length:
+                break
+            try:
+                obj, end = self.decoder.raw_decode(self.buffer, pos)
+            except ValueError:
+                newline = self.buffer.find("\n", pos)
+                if newline == -1:
+                    # Incomplete, wait for more data
+                    break
+                # Undecodable, skip to the next line like a per-line json.loads would
+                pos = newline + 1
+                continue
+            yield obj
+            pos = end
+        self.buffer = self.buffer[pos:]
+
+    def remainder(self):
+        return self.buffer.strip()
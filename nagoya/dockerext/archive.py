@@ -0,0 +1,241 @@
+#
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import io
+import gzip
+import os
+import stat
+import tarfile
+import tempfile
+
+import nagoya.dockerext.api
+
+logger = logging.getLogger("nagoya.dockerext")
+
+# The archive endpoints were added in this API version, older than what docker-py defaults to
+archive_api_version = "1.20"
+
+# Archives for copy_in are kept in memory up to this size
+spool_max_size = 16 * 1024 * 1024
+
+#
+# Compression
+#
+
+# Codecs that Docker's ADD extracts automatically, with their file suffixes
+compression_suffixes = {"none": "", "gzip": ".gz", "xz": ".xz"}
+
+default_compression_level = 6
+
+def open_compressed(fileobj, compression, level=None):
+    """
+    Returns a writable file object that compresses into fileobj as data is
+    written. Closing it doesn't close fileobj. Output only depends on the data
+    written, so compressed archives stay reproducible.
+    """
+
+    level = default_compression_level if level is None else level
+    if compression == "none":
+        return _Uncompressed(fileobj)
+    elif compression == "gzip":
+        # No file name or timestamp in the header
+        return gzip.GzipFile(filename="", fileobj=fileobj, mode="wb", compresslevel=level, mtime=0)
+    elif compression == "xz":
+        try:
+            import lzma
+        except ImportError:
+            raise ValueError("xz compression requires Python 3.3 or above")
+        return lzma.LZMAFile(fileobj, "wb", preset=level)
+    else:
+        raise ValueError("Unknown compression '{compression}'".format(**locals()))
+
+class _Uncompressed(object):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        return self.fileobj.write(data)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, tb):
+        self.close()
+
+#
+# Archive endpoint
+#
+
+def _archive_url(client, container_name):
+    return nagoya.dockerext.api.versioned_url(client, archive_api_version, "/containers/{0}/archive".format(container_name))
+
+def put_archive(client, container_name, path, data):
+    """
+    Extract a tar archive into a container's filesystem. The container doesn't
+    have to be running.
+    """
+
+    logger.debug("Uploading archive of {0} bytes to {1} in container {2}".format(len(data), path, container_name))
+    res = client.put(_archive_url(client, container_name),
+                     params={"path": path},
+                     data=data,
+                     headers={"Content-Type": "application/x-tar"})
+    client._raise_for_status(res)
+
+class MemoryArchive(object):
+    """
+    A tar archive built in memory from host files.
+    """
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.tar = tarfile.open(fileobj=self.buffer, mode="w")
+        self.closed = False
+
+    def add(self, source_path, archive_path, executable=False):
+        if self.closed:
+            raise ValueError("Archive is already closed")
+
+        arcname = os.path.normpath(archive_path).lstrip("/")
+
+        def set_executable(tarinfo):
+            if executable and tarinfo.name == arcname:
+                tarinfo.mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+            return tarinfo
+
+        logger.debug("Adding {source_path} to archive as {arcname}".format(**locals()))
+        self.tar.add(source_path, arcname=arcname, filter=set_executable)
+
+    def getvalue(self):
+        if not self.closed:
+            self.tar.close()
+            self.closed = True
+        return self.buffer.getvalue()
+
+    def put(self, container, path="/"):
+        put_archive(container.client, container.name, path, self.getvalue())
+
+def get_archive(client, container_name, path):
+    """
+    Returns a file-like object streaming a tar archive of a path in a
+    container's filesystem, including volumes. The container doesn't have to
+    be running.
+    """
+
+    logger.debug("Downloading archive of {0} in container {1}".format(path, container_name))
+    # No timeout, large archives can take a while to start
+    res = client._get(_archive_url(client, container_name), params={"path": path}, stream=True, timeout=None)
+    client._raise_for_status(res)
+    return res.raw
+
+def _inside(path):
+    # Relative to the destination, and not leaving it
+    normalized = os.path.normpath(path)
+    return not path.startswith("/") and not normalized == ".." and not normalized.startswith("../")
+
+def _safe_member(member, name, linkname, extracted):
+    if member.name.startswith("/") or not _inside(name) or ".." in name.split("/"):
+        return False
+    if member.islnk():
+        # Hard link targets are archive member names, only those already extracted can be linked
+        return linkname in extracted
+    if member.issym():
+        # Symlink targets are relative to the link's directory
+        return not linkname.startswith("/") and _inside(os.path.join(os.path.dirname(name), linkname))
+    return True
+
+def _resolves_inside(real_root, path):
+    real_path = os.path.realpath(path)
+    return real_path == real_root or real_path.startswith(real_root + os.sep)
+
+def _stays_inside(member, host_dir, real_root, name, linkname):
+    # Checked against the filesystem, since symlinks extracted earlier can point anywhere once combined
+    path = os.path.join(host_dir, name)
+    if not _resolves_inside(real_root, os.path.dirname(path)):
+        return False
+    if member.issym():
+        # Replaced rather than followed, but its target must resolve inside too
+        return _resolves_inside(real_root, os.path.join(os.path.dirname(path), linkname))
+    if member.islnk() and not _resolves_inside(real_root, os.path.join(host_dir, linkname)):
+        return False
+    # Files are written through an existing symlink of the same name
+    return _resolves_inside(real_root, path)
+
+def extract_stream(fileobj, host_dir, strip_root=False, members=None):
+    """
+    Extract a tar stream into host_dir. With strip_root, the first path
+    component (the copied file or directory itself) is removed. If members is
+    given, only those paths (after stripping) are extracted. Members with
+    absolute names, .. components, or paths or links that resolve outside
+    host_dir (including through symlinks extracted earlier) are skipped.
+    """
+
+    if not os.path.exists(host_dir):
+        # Python 2 doesn't have the exists_ok option
+        os.makedirs(host_dir)
+    real_root = os.path.realpath(host_dir)
+
+    extracted = []
+    with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+        for member in tar:
+            name = member.name
+            linkname = member.linkname
+            if strip_root:
+                name = name.partition("/")[2]
+                if name == "":
+                    continue
+                if member.islnk():
+                    root, _, linkname = linkname.partition("/")
+                    if not root == member.name.partition("/")[0]:
+                        linkname = None
+            if members is not None and not name in members:
+                continue
+            if not _safe_member(member, name, linkname, extracted) or not _stays_inside(member, host_dir, real_root, name, linkname):
+                logger.warn("Not extracting unsafe archive member {0}".format(member.name))
+                continue
+            member.name = name
+            member.linkname = linkname
+            tar.extract(member, host_dir)
+            extracted.append(name)
+    return extracted
+
+def copy_out(client, container_name, container_path, host_dir, strip_root=False, members=None):
+    return extract_stream(get_archive(client, container_name, container_path), host_dir, strip_root, members)
+
+def copy_in(client, container_name, host_paths, container_dir):
+    """
+    Copy host files or directories into a directory in a container. The
+    archive is spooled to disk only if it gets large.
+    """
+
+    with tempfile.SpooledTemporaryFile(max_size=spool_max_size) as spool:
+        with tarfile.open(fileobj=spool, mode="w") as tar:
+            for host_path in host_paths:
+                tar.add(host_path, arcname=os.path.basename(os.path.normpath(host_path)))
+        size = spool.tell()
+        spool.seek(0)
+        logger.debug("Uploading archive of {0} bytes to {1} in container {2}".format(size, container_dir, container_name))
+        res = client.put(_archive_url(client, container_name),
+                         params={"path": container_dir},
+                         data=spool,
+                         headers={"Content-Type": "application/x-tar"},
+                         timeout=None)
+        client._raise_for_status(res)
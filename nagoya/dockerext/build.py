@@ -19,12 +19,15 @@ from __future__ import print_function
 import sys
 import logging
 import json
-import re
 import os
+import threading
+import time
 
 import docker
 
 import nagoya.temp
+import nagoya.dockerext.api
+import nagoya.dockerext.image
 
 logger = logging.getLogger("nagoya.dockerext")
 
@@ -38,79 +41,290 @@ class BuildFailed(Exception):
         self.residual_container = residual_container
         self.error_lines = error_lines
 
-# Patterns for watch_build
-detail_pattern = re.compile(r'^ ---> (?P<text>.*)$')
-running_in_pattern = re.compile(r'^Running in (?P<container>.*)$')
-removing_pattern = re.compile(r'^Removing intermediate container (?P<container>.*)$')
+#
+# Build stream handling
+#
+
+class BufferedOutput(object):
+    """
+    Collects text and writes it to a stream from a background thread, flushing
+    periodically rather than per line.
+    """
+
+    def __init__(self, out=None, interval=0.1):
+        self.out = sys.stdout if out is None else out
+        self.interval = interval
+        self.pending = []
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.writer = threading.Thread(target=self._write_pending_loop, name="build-output")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def write(self, text):
+        with self.lock:
+            self.pending.append(text)
+
+    def _write_pending(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        if pending:
+            self.out.write("".join(pending))
+            self.out.flush()
+
+    def _write_pending_loop(self):
+        while not self.closed.is_set():
+            self.closed.wait(self.interval)
+            self._write_pending()
+
+    def close(self):
+        self.closed.set()
+        self.writer.join()
+        self._write_pending()
+
+class BuildStep(object):
+    """
+    Timing and cache information for one Dockerfile instruction of a build.
+    """
+
+    def __init__(self, number, instruction, start):
+        self.number = number
+        self.instruction = instruction
+        self.start = start
+        self.end = None
+        self.cached = False
+        self.layer_id = None
+
+    @property
+    def duration(self):
+        return None if self.end is None else self.end - self.start
+
+    def to_dict(self):
+        return {"number": self.number,
+                "instruction": self.instruction,
+                "start": self.start,
+                "end": self.end,
+                "duration": self.duration,
+                "cached": self.cached,
+                "layer_id": self.layer_id}
+
+class BuildWatcher(object):
+    """
+    Follows the items of a build stream, dispatching on their keys and on the
+    prefixes of stream lines.
+    """
+
+    detail_prefix = " ---> "
+
+    def __init__(self, quiet):
+        self.quiet = quiet
+        self.failed = False
+        self.latest_container = None
+        self.error_lines = []
+        # Only writing while a stream is watched, so nothing is left running if the build can't start
+        self.output = None
+
+        # In order of precedence, the first key present in an item is handled
+        self.item_handlers = [("error", self.on_error),
+                              ("stream", self.on_stream),
+                              ("status", self.on_status)]
+        self.line_handlers = [(self.detail_prefix, self.on_detail),
+                              ("Step ", self.on_step),
+                              ("Successfully built ", self.on_success),
+                              ("Removing intermediate container ", self.on_removing)]
+        self.detail_handlers = [("Running in ", self.on_running_in),
+                                ("Using cache", self.on_using_cache)]
+
+        self.steps = []
+        self.image_id = None
+
+    @staticmethod
+    def _dispatch_prefix(handlers, text, default=None):
+        for prefix, handler in handlers:
+            if text.startswith(prefix):
+                return handler(text, text[len(prefix):])
+        if default is not None:
+            return default(text)
+
+    def on_item(self, item):
+        if isinstance(item, dict):
+            for key, handler in self.item_handlers:
+                if key in item:
+                    return handler(item[key])
+        logger.error("Unknown data: {item}".format(**locals()))
+
+    def on_error(self, text):
+        logger.error(text)
+        self.error_lines.append(text)
+        self.failed = True
+
+    def on_status(self, text):
+        logger.info(text)
+
+    def on_stream(self, text):
+        self._dispatch_prefix(self.line_handlers, text.rstrip(), lambda _: self.on_output(text))
+
+    def on_output(self, text):
+        if self.output is not None:
+            self.output.write(text)
+
+    def _end_step(self):
+        if self.steps and self.steps[-1].end is None:
+            self.steps[-1].end = time.time()
+
+    def on_step(self, line, text):
+        logger.debug(line)
+        self._end_step()
+        # "1 : FROM x" or "1/5 : FROM x"
+        number, _, instruction = text.partition(" : ")
+        self.steps.append(BuildStep(number.split("/")[0], instruction, time.time()))
+        self.on_output(line + "\n")
+
+    def on_success(self, line, image_id):
+        logger.debug(line)
+        self._end_step()
+        self.image_id = image_id
+        self.on_output(line + "\n")
+
+    def on_detail(self, line, text):
+        logger.debug(line)
+        self._dispatch_prefix(self.detail_handlers, text, self.on_layer)
+
+    def on_using_cache(self, text, _):
+        if self.steps:
+            self.steps[-1].cached = True
+
+    def on_layer(self, layer_id):
+        if self.steps:
+            self.steps[-1].layer_id = layer_id
+
+    def on_running_in(self, text, container):
+        self.latest_container = container
+
+    def on_removing(self, line, container):
+        logger.debug(line)
+        if not self.latest_container == container:
+            logger.debug("Docker build removed untracked container {container}".format(**locals()))
+        self.latest_container = None
+
+    def watch(self, stream):
+        decoder = nagoya.dockerext.api.JSONStreamDecoder()
+        if not self.quiet:
+            self.output = BufferedOutput()
+        try:
+            for chunk in stream:
+                for item in decoder.feed(chunk):
+                    self.on_item(item)
+            remainder = decoder.remainder()
+            if remainder:
+                logger.error("Invalid data read from stream: {remainder}".format(**locals()))
+        except KeyboardInterrupt as e:
+            logger.error("User interrupted build")
+            self.failed = True
+        finally:
+            self._end_step()
+            if self.output is not None:
+                self.output.close()
+                self.output = None
+
+        if self.failed:
+            raise BuildFailed(self.latest_container, self.error_lines)
 
 def watch_build(stream, quiet):
-    failed = False
-    latest_container = None
-    error_lines = []
+    watcher = BuildWatcher(quiet)
+    watcher.watch(stream)
+    return watcher.steps
 
-    try:
-        for line_json in stream:
-            try:
-                line_parsed = json.loads(line_json)
-            except ValueError as e:
-                logger.error("Invalid data read from stream: {e}".format(**locals()))
-                continue
-
-            if "error" in line_parsed:
-                logger.error(line_parsed["error"])
-                error_lines.append(line_parsed["error"])
-                failed = True
-            elif "stream" in line_parsed:
-                line_text = line_parsed["stream"]
-                line_text_rstrip = line_text.rstrip()
-
-                detail = detail_pattern.match(line_text_rstrip)
-                if detail:
-                    logger.debug(line_text_rstrip)
-                    text = detail.group("text")
-                    running_in = running_in_pattern.match(text)
-                    if running_in:
-                        latest_container = running_in.group("container")
-                else:
-                    removing = removing_pattern.match(line_text_rstrip)
-                    if removing:
-                        logger.debug(line_text_rstrip)
-                        container = removing.group("container")
-                        if not latest_container == container:
-                            logger.debug("Docker build removed untracked container {container}".format(**locals()))
-                        latest_container = None
-                    else:
-                        if not quiet:
-                            print(line_text, end="")
-                            # Workaround lack of print flush parameter in Python 2 (even with future import)
-                            sys.stdout.flush()
-
-
-            elif "status" in line_parsed:
-                logger.info(line_parsed["status"])
-            else:
-                logger.error("Unknown data: {line_parsed}".format(**locals()))
-    except KeyboardInterrupt as e:
-        logger.error("User interrupted build")
-        failed = True
+#
+# Build reports
+#
+
+class BuildReport(object):
+    """
+    Collects the steps of every BuildContext build while active. Use with
+    "with ... as" blocks.
+    """
+
+    def __init__(self):
+        self.builds = []
+
+    def add(self, image_name, steps, start, end, failed=False):
+        self.builds.append({"image": image_name,
+                            "start": start,
+                            "end": end,
+                            "duration": end - start,
+                            "failed": failed,
+                            "steps": [s.to_dict() for s in steps]})
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump({"builds": self.builds}, f, indent=2, sort_keys=True)
+
+    def format_table(self, slowest=5, instruction_width=60):
+        def fmt_duration(d):
+            return "-" if d is None else "{0:.1f}s".format(d)
+        def fmt_instruction(i):
+            return i if len(i) <= instruction_width else i[:instruction_width - 3] + "..."
+
+        rows = [("Image", "Step", "Time", "Cache", "Layer", "Instruction")]
+        all_steps = []
+        for build in self.builds:
+            for step in build["steps"]:
+                all_steps.append((build["image"], step))
+                rows.append((build["image"],
+                             step["number"],
+                             fmt_duration(step["duration"]),
+                             "hit" if step["cached"] else "miss",
+                             (step["layer_id"] or "-")[:12],
+                             fmt_instruction(step["instruction"])))
+
+        widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]) - 1)]
+        lines = []
+        for row in rows:
+            cells = [c.ljust(w) for c, w in zip(row, widths)] + [row[-1]]
+            lines.append("  ".join(cells))
+
+        lines.append("")
+        for build in self.builds:
+            steps = build["steps"]
+            hits = len([s for s in steps if s["cached"]])
+            status = " FAILED" if build["failed"] else ""
+            lines.append("{0}: {1} total, {2}/{3} steps from cache{4}".format(build["image"], fmt_duration(build["duration"]), hits, len(steps), status))
+
+        timed = sorted((s for s in all_steps if s[1]["duration"] is not None), key=lambda s: s[1]["duration"], reverse=True)
+        if timed:
+            lines.append("")
+            lines.append("Slowest steps:")
+            for image, step in timed[:slowest]:
+                lines.append("  {0} {1} step {2}: {3}".format(fmt_duration(step["duration"]), image, step["number"], fmt_instruction(step["instruction"])))
+
+        return "\n".join(lines)
+
+    def __enter__(self):
+        global active_report
+        active_report = self
+        return self
+
+    def __exit__(self, exc, value, tb):
+        global active_report
+        if active_report is self:
+            active_report = None
 
-    if failed:
-        raise BuildFailed(latest_container, error_lines)
+# The report BuildContext builds are added to, if any
+active_report = None
 
 def get_untagged_images(docker_client):
     for image in docker_client.images():
         if image["RepoTags"] == ["<none>:<none>"]:
             yield image
 
-def clean_untagged_images(docker_client):
-    for image in get_untagged_images(docker_client):
-        image_id = image["Id"]
-        short_id = image_id[:8]
-        try:
-            docker_client.remove_image(image_id)
-            logger.info("Removed image {short_id}".format(**locals()))
-        except docker.errors.APIError as e:
-            logger.error("Couldn't remove image {short_id}: {e}".format(**locals()))
+def is_untagged_image(docker_client, image_id):
+    index = nagoya.dockerext.image.active_index
+    if index is not None:
+        return index.is_untagged(image_id)
+    # API's inspect_image doesn't return data with RepoTags for some unknown reason
+    return any(image["Id"] == image_id for image in get_untagged_images(docker_client))
 
 def cleanup_container(docker_client, container_id):
     # Make sure container is removed
@@ -128,18 +342,15 @@ def cleanup_container(docker_client, container_id):
         if "Image" in container:
             image_id = container["Image"]
             try:
-                found = False
-                # API's inspect_image doesn't return data with RepoTags for some unknown reason
-                for image in get_untagged_images(docker_client):
-                    if image["Id"] == image_id:
-                        found = True
-                        try:
-                            docker_client.remove_image(image_id)
-                            logger.info("Removed image {image_id} for container {container_id}".format(**locals()))
-                        except docker.errors.APIError as e:
-                            logger.debug("Couldn't remove image {image_id} for container {container_id}: {e}".format(**locals()))
-                        break
-                if not found:
+                if is_untagged_image(docker_client, image_id):
+                    try:
+                        docker_client.remove_image(image_id)
+                        logger.info("Removed image {image_id} for container {container_id}".format(**locals()))
+                        if nagoya.dockerext.image.active_index is not None:
+                            nagoya.dockerext.image.active_index.record_removed(image_id)
+                    except docker.errors.APIError as e:
+                        logger.debug("Couldn't remove image {image_id} for container {container_id}: {e}".format(**locals()))
+                else:
                     logger.debug("Image {image_id} for container {container_id} wasn't untagged".format(**locals()))
             except docker.errors.APIError as e:
                 logger.debug("Error when listing images: {e}".format(**locals()))
@@ -184,11 +395,14 @@ class BuildContext(nagoya.temp.TempDirectory):
     def maintainer(self, maintainer):
         self._write_df("MAINTAINER", maintainer)
 
-    def expose(self, port):
-        self._write_df("EXPOSE", port)
+    def expose(self, *ports):
+        self._write_df("EXPOSE", *ports)
 
-    def volume(self, volume):
-        self._write_df("VOLUME", volume)
+    def volume(self, *volumes):
+        if len(volumes) == 1:
+            self._write_df("VOLUME", volumes[0])
+        else:
+            self._write_df("VOLUME", json.dumps(list(volumes)))
 
     def workdir(self, workdir):
         self._write_df("WORKDIR", workdir)
@@ -203,9 +417,25 @@ class BuildContext(nagoya.temp.TempDirectory):
         # Add to image from context dir
         self.add(context_rel_path, image_path)
 
+    def include_files(self, files, context_rel_dir):
+        """
+        Include (source path, image path) pairs under one context directory and
+        add them to the image with a single ADD, so they share one layer.
+        """
+
+        for source_path, image_path in files:
+            super(BuildContext, self).include(source_path, os.path.join(context_rel_dir, image_path.lstrip("/")))
+        self.add(context_rel_dir, "/")
+
     def env(self, key, value):
         self._write_df("ENV", key, value)
 
+    def envs(self, pairs):
+        if len(pairs) == 1:
+            self.env(*pairs[0])
+        elif len(pairs) > 1:
+            self._write_df("ENV", *["{0}={1}".format(k, json.dumps(v)) for k,v in pairs])
+
     def run(self, image_path, args=[]):
         self._write_df("RUN", json.dumps([image_path] + args))
 
@@ -213,13 +443,22 @@ class BuildContext(nagoya.temp.TempDirectory):
         self._write_df("ENTRYPOINT", json.dumps([image_path] + args))
 
     def _build(self):
+        watcher = BuildWatcher(self.quiet)
+        start = time.time()
+        failed = True
         try:
             logger.info("Building {self.image_name}".format(**locals()))
             build_stream = self.docker_client.build(path=self.name, tag=self.image_name, rm=True, stream=True)
-            watch_build(build_stream, self.quiet)
+            watcher.watch(build_stream)
+            failed = False
+            if nagoya.dockerext.image.active_index is not None:
+                nagoya.dockerext.image.active_index.record_tagged(self.image_name)
         except BuildFailed as e:
             cleanup_container(self.docker_client, e.residual_container)
             raise
+        finally:
+            if active_report is not None:
+                active_report.add(self.image_name, watcher.steps, start, time.time(), failed)
 
     def __exit__(self, exc, value, tb):
         try:
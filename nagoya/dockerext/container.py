@@ -15,14 +15,23 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from __future__ import print_function
 import importlib
+import hashlib
+import json
 import logging
 import uuid
 import pprint
+import struct
+import sys
+import threading
+import time
 
 import docker
 import requests
 
+import nagoya.dockerext.archive
+
 logger = logging.getLogger("nagoya.dockerext")
 
 class ContainerExitError(Exception):
@@ -33,6 +42,102 @@ class ContainerExitError(Exception):
         message = "Error code {0}\n\nLogs:\n{1}\n\nInspect:\n{2}\n".format(code, logs, pprint.pformat(inspect))
         super(ContainerExitError, self).__init__(message)
 
+class ContainerTimeoutError(Exception):
+    def __init__(self, container_name, timeout):
+        self.container_name = container_name
+        self.timeout = timeout
+        message = "Container {0} didn't finish within {1} seconds".format(container_name, timeout)
+        super(ContainerTimeoutError, self).__init__(message)
+
+#
+# Output streams
+#
+
+def _read_exact(raw, size):
+    data = b""
+    while len(data) < size:
+        chunk = raw.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def demux_stream(raw, tty=False):
+    """
+    Yields (stream number, bytes) from an attach/logs/exec response. Without a
+    TTY, Docker prefixes each frame with the stream number and length.
+    """
+
+    if tty:
+        while True:
+            chunk = raw.read(4096)
+            if not chunk:
+                return
+            yield 1, chunk
+    else:
+        while True:
+            header = _read_exact(raw, 8)
+            if header is None:
+                return
+            stream_num, length = struct.unpack(">BxxxL", header)
+            data = _read_exact(raw, length)
+            if data is None:
+                return
+            yield stream_num, data
+
+def split_lines(chunks):
+    """
+    Yields complete lines (without the newline) from (stream number, bytes)
+    chunks, buffering each stream separately.
+    """
+
+    partials = dict()
+    for stream_num, data in chunks:
+        lines = (partials.pop(stream_num, b"") + data).split(b"\n")
+        partials[stream_num] = lines.pop()
+        for line in lines:
+            yield stream_num, line
+    for stream_num, partial in partials.items():
+        if partial:
+            yield stream_num, partial
+
+def format_elapsed(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{0}h{1:02d}m{2:02d}s".format(hours, minutes, seconds)
+    elif minutes:
+        return "{0}m{1:02d}s".format(minutes, seconds)
+    else:
+        return "{0}s".format(seconds)
+
+class OutputFollower(threading.Thread):
+    """
+    Prints a container's output as it is produced, each line prefixed with the
+    time and the elapsed time since start_time.
+    """
+
+    def __init__(self, container, start_time, quiet=False):
+        super(OutputFollower, self).__init__(name="follow-" + container.name)
+        self.daemon = True
+        self.container = container
+        self.start_time = start_time
+        self.quiet = quiet
+
+    def run(self):
+        try:
+            for _, line in split_lines(self.container.stream_logs()):
+                if not self.quiet:
+                    now = time.time()
+                    stamp = time.strftime("%H:%M:%S", time.localtime(now))
+                    elapsed = format_elapsed(now - self.start_time)
+                    text = line.decode("utf-8", "replace")
+                    print("[{stamp} +{elapsed}] {text}".format(**locals()))
+                    # Workaround lack of print flush parameter in Python 2 (even with future import)
+                    sys.stdout.flush()
+        except Exception as e:
+            logger.debug("Stopped following output of container {0}: {1}".format(self.container, e))
+
 class Env(object):
     def __init__(self, key, value):
         self.key = key
@@ -132,6 +237,9 @@ class Callspec(object):
         return cls(event_part, event, callback_func)
 
 class Container(object):
+    never_started = "0001-01-01T00:00:00Z"
+    spec_hash_label = "nagoya.spec-hash"
+
     @staticmethod
     def random_name():
         return str(uuid.uuid4())
@@ -223,14 +331,16 @@ class Container(object):
         try:
             self._process_callbacks("pre", "create")
             logger.debug("Attempting to create container {0}".format(self))
-            self.client.create_container(name=self.name,
-                                         image=self.image,
-                                         detach=self.detach, # Doesn't seem to do anything
-                                         volumes=self.volumes_api_container_paths(),
-                                         entrypoint=self.entrypoint,
-                                         working_dir=self.working_dir,
-                                         environment=self.envs_api_formatted(),
-                                         command=[""] if self.commands == [] else self.commands)
+            config = self.client._container_config(image=self.image,
+                                                   detach=self.detach, # Doesn't seem to do anything
+                                                   volumes=self.volumes_api_container_paths(),
+                                                   entrypoint=self.entrypoint,
+                                                   working_dir=self.working_dir,
+                                                   environment=self.envs_api_formatted(),
+                                                   command=[""] if self.commands == [] else self.commands)
+            # docker-py doesn't support labels yet
+            config["Labels"] = {self.spec_hash_label: self.spec_hash()}
+            self.client.create_container_from_config(config, self.name)
             logger.info("Created container {0}".format(self))
             self._process_callbacks("post", "create")
         except docker.errors.APIError as e:
@@ -259,7 +369,7 @@ class Container(object):
 
         if self.run_once:
             container_info = self.client.inspect_container(container=self.name)
-            if container_info["State"]["StartedAt"] == "0001-01-01T00:00:00Z":
+            if container_info["State"]["StartedAt"] == self.never_started:
                 start()
             else:
                 logger.debug("Container {0} is configured to run only once and has been started before".format(self))
@@ -295,11 +405,12 @@ class Container(object):
             else:
                 raise
 
-    def remove(self, not_exists_ok=True):
+    def remove(self, not_exists_ok=True, volumes=False):
         try:
             self._process_callbacks("pre", "remove")
             logger.debug("Attempting to remove container {0}".format(self))
-            self.client.remove_container(self.name, force=True)
+            # With volumes, its anonymous volumes go too, the daemon keeps those other containers use
+            self.client.remove_container(self.name, v=volumes, force=True)
             logger.info("Removed container {0}".format(self))
             self._process_callbacks("post", "remove")
         except docker.errors.APIError as e:
@@ -319,6 +430,57 @@ class Container(object):
         else:
             raise ContainerExitError(status, self.logs(), self.inspect())
 
+    def watch(self, quiet=False, timeout=None, interval=30):
+        """
+        Wait for the container to exit while printing its output. Fails with
+        ContainerTimeoutError and kills the container if timeout (in seconds)
+        passes first.
+        """
+
+        start_time = time.time()
+        follower = OutputFollower(self, start_time, quiet)
+        follower.start()
+
+        while True:
+            elapsed = time.time() - start_time
+            if timeout is None:
+                step = interval
+            else:
+                remaining = timeout - elapsed
+                if remaining <= 0:
+                    logger.error("Container {0} timed out after {1}, killing it".format(self, format_elapsed(elapsed)))
+                    self.client.kill(container=self.name, signal=9)
+                    raise ContainerTimeoutError(self.name, timeout)
+                step = min(interval, remaining)
+
+            try:
+                status = self.wait(timeout=step, error_ok=True)
+                break
+            except requests.exceptions.Timeout:
+                logger.info("Container {0} still running after {1}".format(self, format_elapsed(time.time() - start_time)))
+
+        # Let the follower print anything still buffered
+        follower.join(5)
+        logger.info("Container {0} exited with {1} after {2}".format(self, status, format_elapsed(time.time() - start_time)))
+
+        if status == 0:
+            return status
+        else:
+            raise ContainerExitError(status, self.logs(), self.inspect())
+
+    def stream_logs(self, follow=True):
+        """
+        Yields (stream number, bytes) of the container's output. Doesn't use the
+        client's timeout, since output can stop for any length of time.
+        """
+
+        tty = self.client.inspect_container(self.name)["Config"].get("Tty", False)
+        url = self.client._url("/containers/{0}/logs".format(self.name))
+        params = {"stdout": 1, "stderr": 1, "follow": 1 if follow else 0}
+        res = self.client._get(url, params=params, stream=True, timeout=None)
+        self.client._raise_for_status(res)
+        return demux_stream(res.raw, tty)
+
     def logs(self, not_exists_ok=True):
         try:
             return self.client.logs(self.name)
@@ -337,6 +499,81 @@ class Container(object):
             else:
                 raise
 
+    def state(self):
+        ins = self.inspect()
+        if ins is None:
+            return "missing"
+        state = ins["State"]
+        if state.get("Paused", False):
+            return "paused"
+        elif state["Running"]:
+            return "running"
+        elif state["StartedAt"] == self.never_started:
+            return "created"
+        else:
+            return "exited"
+
+    def copy_out(self, container_path, host_dir, strip_root=False, members=None):
+        """
+        Copy a file or directory from the container (including volumes) into
+        host_dir, in one request. Returns the extracted paths.
+        """
+
+        return nagoya.dockerext.archive.copy_out(self.client, self.name, container_path, host_dir, strip_root, members)
+
+    def copy_in(self, host_paths, container_dir):
+        """
+        Copy host files or directories into a directory in the container, in one
+        request.
+        """
+
+        nagoya.dockerext.archive.copy_in(self.client, self.name, host_paths, container_dir)
+
+    def spec(self):
+        """
+        Everything that determines how the container is created and started,
+        with the image resolved to its ID.
+        """
+
+        try:
+            image_id = self.client.inspect_image(self.image)["Id"]
+        except docker.errors.APIError as e:
+            if e.response.status_code == 404:
+                image_id = None
+            else:
+                raise
+
+        return {"image": image_id,
+                "entrypoint": self.entrypoint,
+                "working_dir": self.working_dir,
+                "commands": self.commands,
+                "envs": self.envs_api_formatted(),
+                "volumes": sorted([v.container_path, v.host_path, v.read_only] for v in self.volumes),
+                "volumes_from": sorted(self.volumes_from_api_formatted()),
+                "links": sorted(list(l) for l in self.links_api_formatted()),
+                "add_capabilities": sorted(self.add_capabilities),
+                "drop_capabilities": sorted(self.drop_capabilities)}
+
+    def spec_hash(self):
+        canonical = json.dumps(self.spec(), sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def drifted(self):
+        """
+        If the existing container was created from a different spec. Containers
+        that don't exist, or were created without a spec hash, haven't drifted.
+        """
+
+        ins = self.inspect()
+        if ins is None:
+            return False
+        labels = ins["Config"].get("Labels") or dict()
+        created_hash = labels.get(self.spec_hash_label)
+        if created_hash is None:
+            logger.debug("Container {0} has no spec hash".format(self))
+            return False
+        return not created_hash == self.spec_hash()
+
     def dependency_names(self):
         deps = set()
 
@@ -390,14 +627,16 @@ class Container(object):
         return self.name
 
 class TempContainer(Container):
-    def __init__(self, image, name=None, **kwargs):
+    def __init__(self, image, name=None, remove_volumes=False, **kwargs):
         image_name = image.split(":")[0]
         if name is None:
             name = image_name + "." + self.random_name()[:8]
+        # Containers of images with VOLUME get anonymous volumes filled from the image
+        self.remove_volumes = remove_volumes
         super(TempContainer, self).__init__(image, name=name, **kwargs)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.remove()
+        self.remove(volumes=self.remove_volumes)
@@ -0,0 +1,91 @@
+#
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Named execute since exec is a keyword in Python 2
+
+import logging
+import sys
+import threading
+
+import nagoya.dockerext.api
+import nagoya.dockerext.container
+
+logger = logging.getLogger("nagoya.dockerext")
+
+# The exec endpoints were added in this API version, older than what docker-py defaults to
+exec_api_version = "1.15"
+
+def _exec_url(client, path):
+    return nagoya.dockerext.api.versioned_url(client, exec_api_version, path)
+
+def exec_create(client, container_name, command):
+    config = {"AttachStdin": False,
+              "AttachStdout": True,
+              "AttachStderr": True,
+              "Tty": False,
+              "Cmd": command}
+    res = client._post_json(_exec_url(client, "/containers/{0}/exec".format(container_name)), config)
+    client._raise_for_status(res)
+    return res.json()["Id"]
+
+def exec_start(client, exec_id):
+    """
+    Yields (stream number, bytes) of the command's output until it exits.
+    """
+
+    url = _exec_url(client, "/exec/{0}/start".format(exec_id))
+    # No timeout, commands can be quiet for any length of time
+    res = client._post_json(url, {"Detach": False, "Tty": False}, stream=True, timeout=None)
+    client._raise_for_status(res)
+    return nagoya.dockerext.container.demux_stream(res.raw)
+
+def exec_inspect(client, exec_id):
+    res = client._get(_exec_url(client, "/exec/{0}/json".format(exec_id)))
+    client._raise_for_status(res)
+    return res.json()
+
+class PrefixedOutput(object):
+    """
+    Writes whole lines from many sources to stdout/stderr, each prefixed with
+    the name of its source, without lines from different sources mixing.
+    """
+
+    def __init__(self, names):
+        self.lock = threading.Lock()
+        self.width = max([len(n) for n in names] + [0])
+
+    def write(self, name, stream_num, line):
+        out = sys.stderr if stream_num == 2 else sys.stdout
+        text = line.decode("utf-8", "replace")
+        with self.lock:
+            out.write("{0:<{1}} | {2}\n".format(name, self.width, text))
+            out.flush()
+
+def exec_container(container, command, output=None):
+    """
+    Run a command in a running container, returning its exit code. Output is
+    written to output (a PrefixedOutput) if given.
+    """
+
+    client = container.client
+    logger.debug("Executing {0} in container {1}".format(command, container))
+    exec_id = exec_create(client, container.name, command)
+    chunks = exec_start(client, exec_id)
+    for stream_num, line in nagoya.dockerext.container.split_lines(chunks):
+        if output is not None:
+            output.write(container.name, stream_num, line)
+    return exec_inspect(client, exec_id)["ExitCode"]
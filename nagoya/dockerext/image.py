@@ -0,0 +1,642 @@
+#
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import re
+import json
+import time
+import collections
+import threading
+import concurrent.futures as futures
+
+import docker
+
+import nagoya.dockerext.api
+import nagoya.dockerext.archive
+import nagoya.dockerext.container
+
+logger = logging.getLogger("nagoya.dockerext")
+
+#
+# Exceptions
+#
+
+class PullFailed(Exception):
+    def __init__(self, failures):
+        self.failures = failures
+        message = "\n".join("{0}: {1}".format(name, error) for name, error in failures)
+        super(PullFailed, self).__init__("Couldn't pull image(s):\n" + message)
+
+#
+# Helpers
+#
+
+def split_image_name(image_name):
+    """
+    Split an image name into repository and tag, with the default tag being
+    latest. Registry ports aren't mistaken for tags.
+    """
+
+    repo, sep, tag = image_name.rpartition(":")
+    if sep == "" or "/" in tag:
+        return (image_name, "latest")
+    return (repo, tag)
+
+def image_exists(client, image_name):
+    try:
+        client.inspect_image(image_name)
+        return True
+    except docker.errors.APIError as e:
+        if e.response.status_code == 404:
+            return False
+        raise
+
+def missing_images(client, image_names):
+    if active_index is not None:
+        return [n for n in image_names if not active_index.exists(n)]
+    return [n for n in image_names if not image_exists(client, n)]
+
+def format_bytes(num):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(num) < 1024.0 or unit == "GB":
+            return "{0:.1f} {1}".format(num, unit)
+        num /= 1024.0
+
+def normalize_name(image_name):
+    return "{0}:{1}".format(*split_image_name(image_name))
+
+# Shortest image ID prefix taken as an ID, the length Docker shows
+min_id_prefix_length = 12
+
+def is_image_id(name):
+    """
+    Whether a name is an image ID or a prefix of one, rather than a repository
+    name. Repositories like cafe are hex too, so short prefixes don't count.
+    """
+
+    return len(name) >= min_id_prefix_length and re.match("^[0-9a-f]+$", name) is not None
+
+#
+# Index
+#
+
+class ImageIndex(object):
+    """
+    A cache of the host's images, keyed by ID with their tags and parents,
+    shared by everything in a run while active. It's loaded with one listing
+    when first used, then kept up to date from build, pull and remove results,
+    only listing again for untagged checks of images it has never seen. Use
+    with "with ... as" blocks.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.RLock()
+        self.loaded = False
+        # image ID -> {"tags": set of tags, "parent": parent ID}
+        self.images = dict()
+        # tag -> image ID
+        self.tags = dict()
+
+    def _list(self):
+        for image in self.client.images():
+            tags = set(t for t in image.get("RepoTags") or [] if not t == "<none>:<none>")
+            self._set(image["Id"], tags, image.get("ParentId"))
+
+    def _load(self):
+        if self.loaded:
+            return
+        logger.debug("Loading image index")
+        self._list()
+        self.loaded = True
+
+    def _set(self, image_id, tags, parent_id):
+        entry = self.images.setdefault(image_id, {"tags": set(), "parent": None})
+        entry["parent"] = parent_id or entry["parent"]
+        for tag in tags:
+            # A tag moves off whatever image had it before
+            previous_id = self.tags.get(tag)
+            if previous_id is not None and not previous_id == image_id:
+                self.images[previous_id]["tags"].discard(tag)
+            self.tags[tag] = image_id
+            entry["tags"].add(tag)
+
+    def _resolve(self, image_id):
+        # Build output and container inspection can give short IDs
+        if image_id in self.images:
+            return image_id
+        if not is_image_id(image_id):
+            return None
+        matches = [i for i in self.images if i.startswith(image_id)]
+        return matches[0] if len(matches) == 1 else None
+
+    def _inspect(self, image_name):
+        try:
+            image = self.client.inspect_image(image_name)
+        except docker.errors.APIError as e:
+            if e.response.status_code == 404:
+                return None
+            raise
+        tags = [normalize_name(image_name)] if not (is_image_id(image_name) and image["Id"].startswith(image_name)) else []
+        self._set(image["Id"], tags, image.get("Parent"))
+        return image["Id"]
+
+    def exists(self, image_name):
+        with self.lock:
+            self._load()
+            if normalize_name(image_name) in self.tags or self._resolve(image_name) is not None:
+                return True
+            # Could have been made outside of this run since the listing
+            return self._inspect(image_name) is not None
+
+    def is_untagged(self, image_id):
+        """
+        Whether an image is a top level image without any tags. Images made
+        since the listing, like the leftovers of failed builds, are found by
+        listing again. Intermediate build layers aren't considered untagged.
+        """
+
+        with self.lock:
+            self._load()
+            resolved = self._resolve(image_id)
+            if resolved is None:
+                logger.debug("Image {image_id} isn't in the index, listing images again".format(**locals()))
+                self._list()
+                resolved = self._resolve(image_id)
+            return resolved is not None and len(self.images[resolved]["tags"]) == 0
+
+    def record_tagged(self, image_name):
+        """
+        Update the index after an image has been built, committed or pulled.
+        """
+
+        with self.lock:
+            if self.loaded:
+                self._inspect(image_name)
+
+    def record_removed(self, image_id):
+        with self.lock:
+            image_id = self._resolve(image_id)
+            if image_id is not None:
+                for tag in self.images.pop(image_id)["tags"]:
+                    self.tags.pop(tag, None)
+
+    def invalidate(self):
+        """
+        Forget the listing, so the next use lists the images again. For long
+        running processes, when images may have changed outside of them.
+        """
+
+        with self.lock:
+            self.loaded = False
+            self.images = dict()
+            self.tags = dict()
+
+    def __enter__(self):
+        global active_index
+        active_index = self
+        return self
+
+    def __exit__(self, exc, value, tb):
+        global active_index
+        if active_index is self:
+            active_index = None
+
+# The index used for existence and tag checks, if any
+active_index = None
+
+#
+# Pulling
+#
+
+class PullProgress(object):
+    """
+    Tracks the layer download progress of concurrent pulls and logs a summary
+    line for each unfinished image periodically.
+    """
+
+    def __init__(self, image_names, interval=5):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.layers = dict((n, dict()) for n in image_names)
+        self.done = set()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._report, name="pull-progress")
+        self.thread.daemon = True
+
+    def update(self, image_name, item):
+        layer_id = item.get("id")
+        if layer_id is None:
+            return
+        detail = item.get("progressDetail") or dict()
+        with self.lock:
+            current, total = self.layers[image_name].get(layer_id, (0, 0))
+            if "total" in detail:
+                current, total = detail.get("current", 0), detail["total"]
+            if item.get("status") in ["Download complete", "Pull complete", "Already exists"]:
+                current = total
+            self.layers[image_name][layer_id] = (current, total)
+
+    def finish(self, image_name):
+        with self.lock:
+            self.done.add(image_name)
+
+    def summary(self, image_name):
+        with self.lock:
+            layers = list(self.layers[image_name].values())
+        current = sum(c for c, _ in layers)
+        total = sum(t for _, t in layers)
+        complete = len([1 for c, t in layers if c >= t])
+        return "{0} of {1} downloaded, {2}/{3} layers".format(format_bytes(current), format_bytes(total), complete, len(layers))
+
+    def _report(self):
+        while not self.stopped.wait(self.interval):
+            for image_name in sorted(self.layers):
+                if not image_name in self.done:
+                    logger.info("Pulling {0}: {1}".format(image_name, self.summary(image_name)))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc, value, tb):
+        self.stopped.set()
+        self.thread.join()
+
+def pull_image(client, image_name, progress=None):
+    repo, tag = split_image_name(image_name)
+    start = time.time()
+    decoder = nagoya.dockerext.api.JSONStreamDecoder()
+    for chunk in client.pull(repo, tag=tag, stream=True):
+        items = [chunk] if isinstance(chunk, dict) else decoder.feed(chunk)
+        for item in items:
+            if "error" in item:
+                raise Exception(item["error"].strip())
+            if progress is not None:
+                progress.update(image_name, item)
+    elapsed = time.time() - start
+    logger.info("Pulled {image_name} in {elapsed:.1f}s".format(**locals()))
+    if active_index is not None:
+        active_index.record_tagged(image_name)
+
+def pull_images(client, image_names, max_workers=4, interval=5):
+    """
+    Pull images concurrently, reporting progress every interval seconds.
+    Raises PullFailed listing any that couldn't be pulled, after the others
+    have finished.
+    """
+
+    if len(image_names) == 0:
+        return
+
+    logger.info("Pulling {0}".format(", ".join(image_names)))
+    failures = []
+    with PullProgress(image_names, interval) as progress:
+        def pull(image_name):
+            try:
+                pull_image(client, image_name, progress)
+            except Exception as e:
+                failures.append((image_name, e))
+            finally:
+                progress.finish(image_name)
+
+        with futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(image_names)))) as pool:
+            for image_name in image_names:
+                pool.submit(pull, image_name)
+
+    if failures:
+        raise PullFailed(failures)
+
+def pull_missing_images(client, image_names, max_workers=4, interval=5):
+    """
+    Pull any of the images that don't exist locally, returning the names of
+    the ones that were pulled.
+    """
+
+    missing = missing_images(client, sorted(set(image_names)))
+    if len(missing) == 0:
+        logger.debug("All of {0} already exist".format(", ".join(sorted(set(image_names)))))
+    pull_images(client, missing, max_workers, interval)
+    return missing
+
+#
+# Cleaning
+#
+
+def is_untagged(image):
+    tags = image.get("RepoTags") or []
+    return all(t == "<none>:<none>" for t in tags)
+
+class ImageGraph(object):
+    """
+    The parent/child relationships of every image on the Docker host, including
+    intermediate images.
+    """
+
+    def __init__(self, images, used_ids=[]):
+        self.images = dict((i["Id"], i) for i in images)
+        self.children = dict((i, set()) for i in self.images)
+        for image_id, image in self.images.items():
+            parent_id = image.get("ParentId")
+            if parent_id in self.children:
+                self.children[parent_id].add(image_id)
+
+        # Tagged images and images used by containers keep all their ancestors
+        self.protected = set()
+        for image_id, image in self.images.items():
+            if not is_untagged(image) or image_id in used_ids:
+                self._protect(image_id)
+
+    @classmethod
+    def from_client(cls, client):
+        used_ids = set()
+        for cont in client.containers(all=True):
+            used_ids.add(cont.get("ImageID") or client.inspect_container(cont["Id"])["Image"])
+        return cls(client.images(all=True), used_ids)
+
+    def _protect(self, image_id):
+        while image_id in self.images and not image_id in self.protected:
+            self.protected.add(image_id)
+            image_id = self.images[image_id].get("ParentId")
+
+    def removable(self):
+        """
+        Images that aren't tagged, used by a container, or the ancestor of one
+        that is.
+        """
+
+        return set(self.images) - self.protected
+
+def remove_images_leaves_first(client, graph, image_ids, max_workers=8):
+    """
+    Remove images concurrently, each only after all its children have been
+    removed. Returns (removed IDs, failed IDs). Images whose children couldn't
+    be removed are skipped.
+    """
+
+    image_ids = set(image_ids)
+    remaining_children = dict((i, len(graph.children[i] & image_ids)) for i in image_ids)
+    lock = threading.Lock()
+    removed = []
+    failed = []
+    pending = []
+
+    def remove(image_id):
+        short_id = image_id[:12]
+        try:
+            # Parents are removed by this function, not by the daemon
+            client.remove_image(image_id, noprune=True)
+            logger.debug("Removed image {short_id}".format(**locals()))
+            if active_index is not None:
+                active_index.record_removed(image_id)
+            success = True
+        except docker.errors.APIError as e:
+            logger.error("Couldn't remove image {short_id}: {e}".format(**locals()))
+            success = False
+
+        with lock:
+            if not success:
+                failed.append(image_id)
+                return
+            removed.append(image_id)
+            parent_id = graph.images[image_id].get("ParentId")
+            if parent_id in remaining_children:
+                remaining_children[parent_id] -= 1
+                if remaining_children[parent_id] == 0:
+                    pending.append(pool.submit(remove, parent_id))
+
+    with futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        with lock:
+            for image_id in image_ids:
+                if remaining_children[image_id] == 0:
+                    pending.append(pool.submit(remove, image_id))
+        # Removals submit their parents, so wait until nothing new is added
+        while True:
+            with lock:
+                waiting = [f for f in pending if not f.done()]
+            if len(waiting) == 0:
+                break
+            futures.wait(waiting)
+
+    return removed, failed
+
+def clean_untagged_images(client, max_workers=8):
+    """
+    Remove every untagged image that isn't needed by a tagged image or a
+    container, leaves first. Returns the number of bytes reclaimed.
+    """
+
+    graph = ImageGraph.from_client(client)
+    removable = graph.removable()
+    logger.info("Found {0} removable image(s) of {1}".format(len(removable), len(graph.images)))
+    removed, failed = remove_images_leaves_first(client, graph, removable, max_workers)
+
+    # Size is each image's own layer, VirtualSize includes its ancestors
+    reclaimed = sum(graph.images[i].get("Size", 0) for i in removed)
+    skipped = len(removable) - len(removed) - len(failed)
+    logger.info("Removed {0} image(s), reclaimed {1}".format(len(removed), format_bytes(reclaimed)))
+    if failed or skipped:
+        logger.warn("{0} image(s) couldn't be removed, {1} skipped since a child wasn't removed".format(len(failed), skipped))
+    return reclaimed
+
+#
+# Sizes
+#
+
+size_units = {"": 1, "b": 1, "k": 1024, "kb": 1024, "m": 1024 ** 2, "mb": 1024 ** 2, "g": 1024 ** 3, "gb": 1024 ** 3}
+
+def parse_size(text):
+    """
+    Parse a size like 500MB, 1.5 GB or 2048 into bytes, with 1024 based units.
+    """
+
+    stripped = text.strip()
+    number = stripped.rstrip("bBkKmMgG ")
+    unit = stripped[len(number):].strip().lower()
+    if not unit in size_units:
+        raise ValueError("Invalid size '{text}'".format(**locals()))
+    return int(float(number) * size_units[unit])
+
+Layer = collections.namedtuple("Layer", ["id", "created_by", "size"])
+
+def image_history(client, image_name):
+    """
+    Returns the layers of an image, oldest first.
+    """
+
+    layers = [Layer(h.get("Id"), h.get("CreatedBy") or "", h.get("Size") or 0) for h in client.history(image_name)]
+    layers.reverse()
+    return layers
+
+def describe_created_by(created_by):
+    """
+    Returns (instruction, arguments) for a layer's CreatedBy command.
+    """
+
+    command = created_by
+    if command.startswith("/bin/sh -c "):
+        command = command[len("/bin/sh -c "):]
+    if command.startswith("#(nop) "):
+        instruction, _, arguments = command[len("#(nop) "):].strip().partition(" ")
+        return (instruction, arguments)
+    return ("RUN", command)
+
+#
+# Squashing
+#
+
+# Import with changes needs this API version, the archive endpoint 1.20
+import_api_version = "1.20"
+
+squash_chunk_size = 1024 * 1024
+
+def config_changes(config):
+    """
+    Dockerfile instructions that recreate an image's config, for importing a
+    filesystem as a new image without losing it.
+    """
+
+    changes = []
+    for env in config.get("Env") or []:
+        k, _, v = env.partition("=")
+        changes.append("ENV {0}={1}".format(k, json.dumps(v)))
+    for port in sorted(config.get("ExposedPorts") or {}):
+        changes.append("EXPOSE {0}".format(port))
+    volumes = sorted(config.get("Volumes") or {})
+    if len(volumes) > 0:
+        changes.append("VOLUME {0}".format(json.dumps(volumes)))
+    if config.get("WorkingDir"):
+        changes.append("WORKDIR {0}".format(config["WorkingDir"]))
+    if config.get("User"):
+        changes.append("USER {0}".format(config["User"]))
+    if config.get("Entrypoint"):
+        changes.append("ENTRYPOINT {0}".format(json.dumps(config["Entrypoint"])))
+    if config.get("Cmd"):
+        changes.append("CMD {0}".format(json.dumps(config["Cmd"])))
+    return changes
+
+def import_image(client, chunks, image_name, changes=[]):
+    """
+    Create an image from a tar stream given as an iterable of chunks. The
+    request body is sent chunked, so the stream is never held in memory.
+    Returns the new image's ID.
+    """
+
+    repo, tag = split_image_name(image_name)
+    url = nagoya.dockerext.api.versioned_url(client, import_api_version, "/images/create")
+    params = {"fromSrc": "-", "repo": repo, "tag": tag, "changes": changes}
+    # No timeout, the upload lasts as long as the stream
+    res = client._post(url, params=params, data=chunks, headers={"Content-Type": "application/tar"}, timeout=None)
+    client._raise_for_status(res)
+
+    image_id = None
+    decoder = nagoya.dockerext.api.JSONStreamDecoder()
+    for item in decoder.feed(res.content):
+        if "error" in item:
+            raise Exception(item["error"].strip())
+        image_id = item.get("status", image_id)
+    return image_id
+
+def squash_image(client, image_name):
+    """
+    Replace an image with one that has its whole filesystem in a single layer
+    and the same config. The filesystem is streamed from a created (never
+    started) container through the archive endpoint, which unlike export
+    includes the contents of volumes, so persisted data is kept.
+    """
+
+    config = client.inspect_image(image_name)["Config"] or dict()
+    changes = config_changes(config)
+    start = time.time()
+    logger.info("Squashing image {image_name}".format(**locals()))
+
+    with nagoya.dockerext.container.TempContainer(image_name, remove_volumes=True) as container:
+        container.client = client
+        # Never started, only needs a command if the image has neither
+        container.commands = [] if config.get("Entrypoint") or config.get("Cmd") else ["/bin/true"]
+        container.create()
+        raw = nagoya.dockerext.archive.get_archive(client, container.name, "/")
+        chunks = iter(lambda: raw.read(squash_chunk_size), b"")
+        image_id = import_image(client, chunks, image_name, changes)
+
+    elapsed = time.time() - start
+    logger.info("Squashed image {image_name} in {elapsed:.1f}s".format(**locals()))
+    if active_index is not None:
+        active_index.record_tagged(image_name)
+    return image_id
+
+#
+# Transferring
+#
+
+transfer_chunk_size = 1024 * 1024
+
+def image_id(client, image_name):
+    """
+    Returns the ID of an image, or None if it doesn't exist.
+    """
+
+    try:
+        return client.inspect_image(image_name)["Id"]
+    except docker.errors.APIError as e:
+        if e.response.status_code == 404:
+            return None
+        raise
+
+def save_image(client, image_name):
+    """
+    Returns a file-like object streaming a tar archive of an image, with its
+    parent layers and tags, in the format load_image takes.
+    """
+
+    # No timeout, saving starts slowly for large images
+    res = client._get(client._url("/images/{0}/get".format(image_name)), stream=True, timeout=None)
+    client._raise_for_status(res)
+    return res.raw
+
+def load_image(client, chunks):
+    """
+    Load images from a save archive given as an iterable of chunks, sent
+    chunked like import_image.
+    """
+
+    res = client._post(client._url("/images/load"), data=chunks, headers={"Content-Type": "application/x-tar"}, timeout=None)
+    client._raise_for_status(res)
+    decoder = nagoya.dockerext.api.JSONStreamDecoder()
+    for item in decoder.feed(res.content):
+        if "error" in item:
+            raise Exception(item["error"].strip())
+
+def transfer_image(source_client, dest_client, image_name):
+    """
+    Copy an image and its tag from one daemon to another, streaming the save
+    archive straight into the load. The archive includes every parent layer,
+    the destination skips those it already has.
+    """
+
+    logger.info("Transferring image {image_name} from {0} to {1}".format(source_client.base_url, dest_client.base_url, **locals()))
+    start = time.time()
+    sent = [0]
+    raw = save_image(source_client, image_name)
+    def chunks():
+        for chunk in iter(lambda: raw.read(transfer_chunk_size), b""):
+            sent[0] += len(chunk)
+            yield chunk
+    load_image(dest_client, chunks())
+    elapsed = time.time() - start
+    size = format_bytes(sent[0])
+    logger.info("Transferred image {image_name} ({size}) in {elapsed:.1f}s".format(**locals()))
@@ -0,0 +1,176 @@
+#
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import os
+import re
+
+logger = logging.getLogger("nagoya.layout")
+
+#
+# Python import scanning
+#
+
+# Line based rather than using ast, since run scripts may be written for a
+# different Python version than the one running moromi
+import_pattern = re.compile(r'^\s*import\s+(?P<modules>[^#]+)')
+from_import_pattern = re.compile(r'^\s*from\s+(?P<module>\.*[\w.]*)\s+import\s+(?P<names>[^#]+)')
+
+def _split_names(text):
+    names = []
+    for part in text.replace("(", "").replace(")", "").replace("\\", "").split(","):
+        words = part.split()
+        if len(words) > 0:
+            names.append(words[0])
+    return names
+
+def scan_imports(path):
+    """
+    Returns a list of (level, module name, imported names) for the import
+    statements in a Python source file. Level is the number of leading dots of
+    a relative import.
+    """
+
+    imports = []
+    with open(path) as f:
+        lines = iter(f.read().splitlines())
+    for line in lines:
+        match = from_import_pattern.match(line)
+        if match:
+            module = match.group("module")
+            names_text = match.group("names")
+            # Parenthesised names can continue over several lines
+            while "(" in names_text and not ")" in names_text:
+                names_text += " " + next(lines, ")")
+            level = len(module) - len(module.lstrip("."))
+            imports.append((level, module.lstrip("."), _split_names(names_text)))
+            continue
+
+        match = import_pattern.match(line)
+        if match:
+            for module in _split_names(match.group("modules")):
+                imports.append((0, module, []))
+    return imports
+
+def is_python_script(path):
+    if path.endswith(".py"):
+        return True
+    with open(path, "rb") as f:
+        first_line = f.readline()
+    return first_line.startswith(b"#!") and b"python" in first_line
+
+#
+# Planner
+#
+
+class LayerPlanner(object):
+    """
+    Works out which lib files each run script needs, so that a run's layer is
+    only invalidated by changes to files it imports. Libs are given as
+    (source path, image path) pairs, like the lib option of images.
+    """
+
+    def __init__(self, libs):
+        self.libs = libs
+        # image path -> source path of every file in the libs
+        self.files = dict()
+        for source_path, image_path in libs:
+            if os.path.isdir(source_path):
+                for dirpath, dirnames, filenames in os.walk(source_path):
+                    image_dir = os.path.join(image_path, os.path.relpath(dirpath, source_path))
+                    for filename in filenames:
+                        self.files[os.path.normpath(os.path.join(image_dir, filename))] = os.path.join(dirpath, filename)
+            else:
+                self.files[os.path.normpath(image_path)] = source_path
+        self.added = set()
+
+    def _module_files(self, root, module):
+        # The files Python would load for a module and its parent packages
+        found = []
+        parts = module.split(".") if module else []
+        for i in range(1, len(parts) + 1):
+            base = os.path.join(root, *parts[:i])
+            for candidate in [os.path.join(base, "__init__.py"), base + ".py"]:
+                if candidate in self.files:
+                    found.append(candidate)
+                    break
+            else:
+                break
+        return found
+
+    def _import_files(self, image_path, root):
+        files = []
+        for level, module, names in scan_imports(self.files.get(image_path, image_path)):
+            if level > 0:
+                base = os.path.dirname(image_path)
+                for _ in range(level - 1):
+                    base = os.path.dirname(base)
+                module_root = base
+            else:
+                module_root = root
+            files.extend(self._module_files(module_root, module))
+            # "from package import module" loads the submodules too
+            for name in names:
+                files.extend(self._module_files(module_root, module + "." + name if module else name))
+        return files
+
+    def dependencies(self, source_path, image_path):
+        """
+        Returns the set of lib image paths that a run script imports, directly
+        or through other lib files. Returns None if the script isn't Python, in
+        which case it could need any of the libs.
+        """
+
+        if not is_python_script(source_path):
+            return None
+
+        # Imports are resolved against the script's directory, the first entry of sys.path
+        root = os.path.dirname(os.path.normpath(image_path))
+        needed = set()
+        pending = [None]
+        while len(pending) > 0:
+            current = pending.pop()
+            if current is None:
+                found = self._import_files(source_path, root)
+            else:
+                found = self._import_files(current, root)
+            for path in found:
+                if not path in needed:
+                    needed.add(path)
+                    pending.append(path)
+        return needed
+
+    def run_files(self, source_path, image_path):
+        """
+        Returns (source path, image path) pairs of the lib files a run script
+        needs that earlier runs haven't already added, or None if all the libs
+        have to be added.
+        """
+
+        needed = self.dependencies(source_path, image_path)
+        if needed is None:
+            logger.debug("Can't tell which libs {source_path} needs, adding all of them".format(**locals()))
+            self.added.update(self.files)
+            return None
+
+        new = sorted(needed - self.added)
+        self.added.update(new)
+        logger.debug("Run {image_path} needs {0} lib files, {1} not added yet".format(len(needed), len(new), **locals()))
+        return [(self.files[p], p) for p in new]
+
+    def all_added(self):
+        return self.added >= set(self.files)
@@ -15,17 +15,26 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from __future__ import print_function
 import logging
 import os
 import re
+import json
+import hashlib
 import collections
 import itertools
+import threading
+import time
 
 import docker
 import toposort
 
+import nagoya.dockerext.archive
 import nagoya.dockerext.build
+import nagoya.dockerext.image
 import nagoya.buildcsys
+import nagoya.layout
+import nagoya.schedule
 import nagoya.cli.cfg
 
 logger = logging.getLogger("nagoya.build")
@@ -37,6 +46,9 @@ logger = logging.getLogger("nagoya.build")
 class InvalidFormat(Exception):
     pass
 
+class SizeExceeded(Exception):
+    pass
+
 #
 # Helpers
 #
@@ -67,36 +79,123 @@ def parse_dest_spec(spec, opt_name, image_name):
     else:
         raise InvalidFormat("Invalid {opt_name} specification '{spec}' for image {image_name}".format(**locals()))
 
+def setup_build_root(bcs, image_name, image_config):
+    if "timeout" in image_config:
+        bcs.root_timeout = float(image_config["timeout"])
+
+    if "entrypoint" in image_config:
+        entrypoint_spec = image_config["entrypoint"]
+        res_paths = parse_dir_spec(entrypoint_spec, "entrypoint", image_name)
+        bcs.root.working_dir = res_paths.dest_dir
+        bcs.root.entrypoint = res_paths.dest_path
+        bcs.volume_include(bcs.root, res_paths.src_path, res_paths.dest_path, executable=True)
+
+    for lib_spec in optional_plural(image_config, "libs"):
+        res_paths = parse_dir_spec(lib_spec, "lib", image_name)
+        bcs.volume_include(bcs.root, res_paths.src_path, res_paths.dest_path)
+
+    for commit_spec in optional_plural(image_config, "commits"):
+        dest = parse_dest_spec(commit_spec, "commits", image_name)
+        logger.debug("Container {dest.container} will be committed to {dest.image}".format(**locals()))
+        bcs.commit(dest.container, dest.image)
+
+    for option_name, persist_option in [("persist_delta", "delta"), ("persist_reproducible", "reproducible")]:
+        if image_config.get(option_name, False):
+            bcs.persist_options[persist_option] = True
+    compression = image_config.get("persist_compression", "none")
+    if not compression in nagoya.dockerext.archive.compression_suffixes:
+        raise InvalidFormat("Invalid persist_compression '{compression}' for image {image_name}".format(**locals()))
+    if not compression == "none":
+        bcs.persist_options["compression"] = compression
+        if "persist_compression_level" in image_config:
+            bcs.persist_options["compression_level"] = int(image_config["persist_compression_level"])
+
+    for persist_spec in optional_plural(image_config, "persists"):
+        dest = parse_dest_spec(persist_spec, "persists", image_name)
+        logger.debug("Container {dest.container} will be persisted to {dest.image}".format(**locals()))
+        bcs.persist(dest.container, dest.image)
+
 def build_container_system(image_name, image_config, client, quiet, extra_env):
     logger.info("Creating container system for {image_name}".format(**locals()))
 
     sys_config = nagoya.cli.cfg.read_one(image_config["system"], ["detach", "run_once"])
 
-    with nagoya.buildcsys.BuildContainerSystem.from_dict(sys_config, client=client) as bcs:
+    include_method = image_config.get("include_method", "volume")
+    with nagoya.buildcsys.BuildContainerSystem.from_dict(sys_config, client=client, include_method=include_method) as bcs:
         bcs.cleanup = "remove"
         bcs.quiet = quiet
         bcs.root_name(image_config["root"])
-
-        if "entrypoint" in image_config:
-            entrypoint_spec = image_config["entrypoint"]
-            res_paths = parse_dir_spec(entrypoint_spec, "entrypoint", image_name)
-            bcs.root.working_dir = res_paths.dest_dir
-            bcs.root.entrypoint = res_paths.dest_path
-            bcs.volume_include(bcs.root, res_paths.src_path, res_paths.dest_path, executable=True)
-
-        for lib_spec in optional_plural(image_config, "libs"):
-            res_paths = parse_dir_spec(lib_spec, "lib", image_name)
-            bcs.volume_include(bcs.root, res_paths.src_path, res_paths.dest_path)
-
-        for commit_spec in optional_plural(image_config, "commits"):
-            dest = parse_dest_spec(commit_spec, "commits", image_name)
-            logger.debug("Container {dest.container} will be committed to {dest.image}".format(**locals()))
-            bcs.commit(dest.container, dest.image)
-
-        for persist_spec in optional_plural(image_config, "persists"):
-            dest = parse_dest_spec(persist_spec, "persists", image_name)
-            logger.debug("Container {dest.container} will be persisted to {dest.image}".format(**locals()))
-            bcs.persist(dest.container, dest.image)
+        setup_build_root(bcs, image_name, image_config)
+
+def build_warm_container_system(image_names, images_config, client, quiet, extra_env):
+    system_path = images_config[image_names[0]]["system"]
+    logger.info("Creating warm container system for {0}".format(", ".join(image_names)))
+
+    sys_config = nagoya.cli.cfg.read_one(system_path, ["detach", "run_once"])
+    root_names = [images_config[n]["root"] for n in image_names]
+
+    with nagoya.buildcsys.WarmBuildContainerSystem(sys_config, root_names, client=client, quiet=quiet) as system:
+        for image_name in image_names:
+            logger.info("Running container system stage for {image_name}".format(**locals()))
+            image_config = images_config[image_name]
+            include_method = image_config.get("include_method", "volume")
+            with system.stage(image_config["root"], include_method) as stage:
+                setup_build_root(stage, image_name, image_config)
+
+def is_container_system(image_config):
+    return not container_system_option_names.isdisjoint(image_config.keys())
+
+def container_system_outputs(image_name, image_config):
+    for opt_name in ["commits", "persists"]:
+        for spec in optional_plural(image_config, opt_name):
+            yield parse_dest_spec(spec, opt_name, image_name).image.split(":", 1)[0]
+
+def group_warm_systems(images_config, image_names):
+    """
+    Groups consecutive container system builds that can share one warm system:
+    they use the same system file, the system doesn't depend on any of their
+    root containers, and the system doesn't use images they produce.
+    """
+
+    groups = []
+    group_system = None
+    group_roots = set()
+    group_outputs = set()
+    sys_config = None
+
+    for image_name in image_names:
+        image_config = images_config[image_name]
+        if not is_container_system(image_config):
+            groups.append([image_name])
+            group_system = None
+            continue
+
+        system = os.path.abspath(image_config["system"])
+        if system == group_system:
+            roots = group_roots | {image_config["root"]}
+            joinable = True
+            for cont_name, cont_config in sys_config.items():
+                if cont_name in roots:
+                    continue
+                if cont_config["image"].split(":", 1)[0] in group_outputs:
+                    joinable = False
+                for dep_opt in ["links", "volumes_from"]:
+                    for dep_spec in optional_plural(cont_config, dep_opt):
+                        if dep_spec.split(":", 1)[0] in roots:
+                            joinable = False
+            if joinable:
+                groups[-1].append(image_name)
+                group_roots = roots
+                group_outputs.update(container_system_outputs(image_name, image_config))
+                continue
+
+        groups.append([image_name])
+        group_system = system
+        group_roots = {image_config["root"]}
+        group_outputs = set(container_system_outputs(image_name, image_config))
+        sys_config = nagoya.cli.cfg.read_one(image_config["system"])
+
+    return groups
 
 #
 # Standard image build
@@ -139,6 +238,10 @@ class Previous(object):
             return False
 
 def build_image(image_name, image_config, client, quiet, extra_env):
+    if image_config.get("plan_layers", False):
+        build_planned_image(image_name, image_config, client, quiet, extra_env)
+        return
+
     logger.info("Generating files for {image_name}".format(**locals()))
     with nagoya.dockerext.build.BuildContext(image_name, image_config["from"], client, quiet) as context:
         context.maintainer(image_config["maintainer"])
@@ -175,11 +278,267 @@ def build_image(image_name, image_config, client, quiet, extra_env):
             add_workdir(res_paths.dest_dir)
             context.entrypoint(res_paths.dest_path)
 
+def build_planned_image(image_name, image_config, client, quiet, extra_env):
+    """
+    Like build_image, but orders the Dockerfile for layer cache reuse. Each run
+    is preceded only by the lib files it imports, the rest of the libs are
+    added after the last run, and metadata instructions are merged.
+    """
+
+    logger.info("Generating planned files for {image_name}".format(**locals()))
+    lib_paths = [parse_dir_spec(spec, "lib", image_name) for spec in optional_plural(image_config, "libs")]
+    planner = nagoya.layout.LayerPlanner([(p.src_path, p.dest_path) for p in lib_paths])
+
+    with nagoya.dockerext.build.BuildContext(image_name, image_config["from"], client, quiet) as context:
+        context.maintainer(image_config["maintainer"])
+
+        ports = list(optional_plural(image_config, "exposes"))
+        if len(ports) > 0:
+            context.expose(*ports)
+
+        volumes = list(optional_plural(image_config, "volumes"))
+        if len(volumes) > 0:
+            context.volume(*volumes)
+
+        # Runs can use the environment, so it has to come before them
+        env_pairs = [env_spec.split("=", 1) for env_spec in itertools.chain(optional_plural(image_config, "envs"), extra_env)]
+        context.envs(env_pairs)
+
+        libs_added = Previous(False)
+        def add_all_libs():
+            if not libs_added(True):
+                for res_paths in lib_paths:
+                    context.include(res_paths.src_path, res_paths.dest_path)
+
+        previous_workdir = Previous("")
+        def add_workdir(image_dir):
+            if not previous_workdir(image_dir):
+                context.workdir(image_dir)
+
+        for i, run_spec in enumerate(optional_plural(image_config, "runs")):
+            res_paths = parse_dir_spec(run_spec, "run", image_name)
+            lib_files = planner.run_files(res_paths.src_path, res_paths.dest_path)
+            if lib_files is None:
+                add_all_libs()
+            elif len(lib_files) > 0 and not libs_added.value:
+                context.include_files(lib_files, "layers/run{0}".format(i))
+            context.include(res_paths.src_path, res_paths.dest_path, executable=True)
+            add_workdir(res_paths.dest_dir)
+            context.run(res_paths.dest_path)
+
+        # Files the runs didn't need, and the final copy of everything else
+        add_all_libs()
+
+        if "entrypoint" in image_config:
+            entrypoint_spec = image_config["entrypoint"]
+            res_paths = parse_dir_spec(entrypoint_spec, "entrypoint", image_name)
+            context.include(res_paths.src_path, res_paths.dest_path, executable=True)
+            add_workdir(res_paths.dest_dir)
+            context.entrypoint(res_paths.dest_path)
+
+#
+# Shared lib base images
+#
+
+SharedBase = collections.namedtuple("SharedBase", ["image", "from_image", "maintainer", "lib_specs"])
+
+shared_base_repo = "nagoya-libs"
+
+def plan_shared_bases(images_config, image_names):
+    """
+    Finds lib specs common to two or more standard images with the same from
+    image, and returns a dict of image name to the SharedBase it should be
+    rebased on. Base image names are derived from their contents, so later runs
+    reuse them.
+    """
+
+    by_from = collections.OrderedDict()
+    for image_name in image_names:
+        image_config = images_config[image_name]
+        if not is_container_system(image_config):
+            by_from.setdefault(image_config["from"], []).append(image_name)
+
+    bases = dict()
+    for from_image, members in by_from.items():
+        if len(members) < 2:
+            continue
+
+        member_specs = [list(optional_plural(images_config[n], "libs")) for n in members]
+        common = [spec for spec in member_specs[0] if all(spec in specs for specs in member_specs[1:])]
+        if len(common) == 0:
+            continue
+
+        maintainers = set(images_config[n]["maintainer"] for n in members)
+        maintainer = maintainers.pop() if len(maintainers) == 1 else None
+
+        # Relative source paths depend on the working directory
+        key_paths = [parse_dir_spec(spec, "lib", members[0]) for spec in common]
+        key = "\n".join([from_image] + ["{0} at {1}".format(os.path.abspath(p.src_path), p.dest_path) for p in key_paths])
+        tag = hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+        base = SharedBase("{0}:{1}".format(shared_base_repo, tag), from_image, maintainer, common)
+        logger.debug("Images {0} will share base {1}".format(", ".join(members), base.image))
+        for image_name in members:
+            bases[image_name] = base
+
+    return bases
+
+def build_shared_base(base, client, quiet):
+    logger.info("Generating files for shared lib base {base.image}".format(**locals()))
+    with nagoya.dockerext.build.BuildContext(base.image, base.from_image, client, quiet) as context:
+        if base.maintainer is not None:
+            context.maintainer(base.maintainer)
+        for lib_spec in base.lib_specs:
+            res_paths = parse_dir_spec(lib_spec, "lib", base.image)
+            context.include(res_paths.src_path, res_paths.dest_path)
+
+def rebased_config(image_config, base):
+    rebased = dict(image_config)
+    rebased["from"] = base.image
+    remaining = [spec for spec in optional_plural(image_config, "libs") if not spec in base.lib_specs]
+    if len(remaining) > 0:
+        rebased["libs"] = "\n".join(remaining)
+    else:
+        rebased.pop("libs", None)
+    return rebased
+
+#
+# Image sizes
+#
+
+ImageSize = collections.namedtuple("ImageSize", ["image", "parent", "total", "inherited", "layers"])
+LayerSize = collections.namedtuple("LayerSize", ["size", "instruction", "arguments", "source"])
+
+def layer_sources(image_name, image_config):
+    """
+    Returns (image path, description) pairs of the resources that can appear in
+    a standard image's layer commands, most specific path first.
+    """
+
+    sources = []
+    for opt_name, kind in [("runs", "run"), ("libs", "lib"), ("entrypoint", "entrypoint")]:
+        for spec in optional_plural(image_config, opt_name):
+            res_paths = parse_dir_spec(spec, kind, image_name)
+            sources.append((res_paths.dest_path, "{kind} {res_paths.src_path}".format(**locals())))
+    return sorted(sources, key=lambda s: len(s[0]), reverse=True)
+
+def produced_images(section, image_config):
+    """
+    Returns (image name, parent image, sources, description of own layers) for
+    each image a section produces. Own layer description is None when layers
+    should be attributed to sources.
+    """
+
+    if not is_container_system(image_config):
+        return [(section, image_config["from"], layer_sources(section, image_config), None)]
+
+    sys_config = nagoya.cli.cfg.read_one(image_config["system"])
+    produced = []
+    for opt_name, kind in [("commits", "commit of"), ("persists", "persisted volumes of")]:
+        for spec in optional_plural(image_config, opt_name):
+            dest = parse_dest_spec(spec, opt_name, section)
+            parent = sys_config[dest.container]["image"]
+            produced.append((dest.image, parent, [], "{kind} {dest.container}".format(**locals())))
+    return produced
+
+def analyse_image_size(client, image_name, parent_name, sources, own_description=None):
+    layers = nagoya.dockerext.image.image_history(client, image_name)
+    try:
+        inherited_count = len(nagoya.dockerext.image.image_history(client, parent_name))
+    except docker.errors.APIError as e:
+        logger.debug("Couldn't get history of parent {parent_name}: {e}".format(**locals()))
+        inherited_count = 0
+    if inherited_count >= len(layers):
+        # Squashed, nothing is shared with the parent any more
+        inherited_count = 0
+
+    inherited = sum(l.size for l in layers[:inherited_count])
+    own = []
+    for layer in layers[inherited_count:]:
+        instruction, arguments = nagoya.dockerext.image.describe_created_by(layer.created_by)
+        source = own_description
+        if source is None:
+            source = next((desc for path, desc in sources if path in layer.created_by), "")
+        own.append(LayerSize(layer.size, instruction, arguments, source))
+
+    return ImageSize(image_name, parent_name, sum(l.size for l in layers), inherited, own)
+
+def largest_layers(image_size, count=3, min_share=0.1):
+    # Only layers that make up a meaningful share of the image's own size
+    own = image_size.total - image_size.inherited
+    significant = [l for l in image_size.layers if l.size > 0 and l.size >= own * min_share]
+    return sorted(significant, key=lambda l: l.size, reverse=True)[:count]
+
+def format_image_size(image_size, max_size=None, argument_width=50):
+    fmt = nagoya.dockerext.image.format_bytes
+    own = image_size.total - image_size.inherited
+    budget = "" if max_size is None else ", max {0}".format(fmt(max_size))
+    lines = ["{0}: {1} total, {2} in its own layers{3}".format(image_size.image, fmt(image_size.total), fmt(own), budget)]
+
+    largest = largest_layers(image_size)
+    for layer in image_size.layers:
+        arguments = layer.arguments if len(layer.arguments) <= argument_width else layer.arguments[:argument_width - 3] + "..."
+        flag = "  <- largest" if layer in largest else ""
+        lines.append("    {0:>10}  {1:<10} {2}  {3}{4}".format(fmt(layer.size), layer.instruction, arguments, layer.source, flag))
+    lines.append("    {0:>10}  (from {1})".format(fmt(image_size.inherited), image_size.parent))
+    return "\n".join(lines)
+
+def squash_section_images(client, section, image_config):
+    for image_name, _, _, _ in produced_images(section, image_config):
+        nagoya.dockerext.image.squash_image(client, image_name)
+
+def finish_section(client, section, image_config):
+    """
+    Post-build steps for each section, once its images exist.
+    """
+
+    if image_config.get("squash", False):
+        squash_section_images(client, section, image_config)
+    check_image_sizes(client, section, image_config)
+
+def check_image_sizes(client, section, image_config):
+    """
+    Post-build hook: logs the largest contributors to each image a section
+    produced, and raises SizeExceeded if one is over the section's max_size.
+    """
+
+    max_size = nagoya.dockerext.image.parse_size(image_config["max_size"]) if "max_size" in image_config else None
+    for image_name, parent, sources, own_description in produced_images(section, image_config):
+        image_size = analyse_image_size(client, image_name, parent, sources, own_description)
+        fmt = nagoya.dockerext.image.format_bytes
+        largest = ", ".join("{0} {1}".format(l.source or l.instruction, fmt(l.size)) for l in largest_layers(image_size))
+        logger.info("Image {image_name} is {0}, largest layers: {1}".format(fmt(image_size.total), largest or "none", **locals()))
+        if max_size is not None and image_size.total > max_size:
+            raise SizeExceeded("Image {image_name} is {0}, over the max_size of {1} for {section}\n{2}".format(fmt(image_size.total), fmt(max_size), format_image_size(image_size, max_size), **locals()))
+
+def show_image_sizes(config, names=None):
+    """
+    Print the size analysis of images, given as section names or the names of
+    images sections produce. Returns the number of images over their max_size.
+    """
+
+    docker_client = docker.Client(timeout=10)
+    docker_client.ping()
+
+    wanted = None if names is None else set(names)
+    over = 0
+    for section, image_config in config.items():
+        max_size = nagoya.dockerext.image.parse_size(image_config["max_size"]) if "max_size" in image_config else None
+        for image_name, parent, sources, own_description in produced_images(section, image_config):
+            if wanted is not None and not section in wanted and not image_name in wanted:
+                continue
+            image_size = analyse_image_size(docker_client, image_name, parent, sources, own_description)
+            print(format_image_size(image_size, max_size))
+            print()
+            if max_size is not None and image_size.total > max_size:
+                logger.error("Image {image_name} is over its max_size".format(**locals()))
+                over += 1
+    return over
+
 #
 # Build images
 #
 
-def resolve_dep_order(images_config):
+def find_provided_images(images_config):
     # Figure out what images are provided by this config
     # Anything not provided is assumed to exist already
     provided_images = dict()
@@ -191,10 +550,51 @@ def resolve_dep_order(images_config):
                 dest = parse_dest_spec(commit_spec, "commits", image_name)
                 provided_images[dest.image] = image_name
             for persist_spec in optional_plural(image_config, "persists"):
-                dest = parse_dest_spec(commit_spec, "persists", image_name)
+                dest = parse_dest_spec(persist_spec, "persists", image_name)
                 provided_images[dest.image] = image_name
+    return provided_images
+
+def uses_persist_helper(image_config):
+    archive_options = [image_config.get(n, False) for n in ["persist_delta", "persist_reproducible"]]
+    return not any(archive_options) and image_config.get("persist_compression", "none") == "none"
+
+def required_images(image_config):
+    """
+    Returns the images a section's build uses: its from image, or the images
+    of its system's containers and the persist helper.
+    """
+
+    if not is_container_system(image_config):
+        return [image_config["from"]]
+
+    sys_config = nagoya.cli.cfg.read_one(image_config["system"])
+    required = [cont_config["image"] for cont_config in sys_config.values()]
+    if "persists" in image_config and uses_persist_helper(image_config):
+        required.append(nagoya.buildcsys.persist_helper_image)
+    return required
+
+def find_external_images(images_config, image_names):
+    """
+    Returns the images that building image_names needs but that no section of
+    the config provides, so they have to exist already or be pulled.
+    """
+
+    provided_images = find_provided_images(images_config)
+    external = set()
+    for image_name in image_names:
+        for required in required_images(images_config[image_name]):
+            if not required.split(":", 1)[0] in provided_images:
+                external.add(required)
+    return sorted(external)
+
+def image_dependencies(images_config):
+    """
+    Returns a dict of each section name to the set of sections that provide
+    images it needs, and so have to be built before it.
+    """
+
+    provided_images = find_provided_images(images_config)
 
-    # Figure out the images required (among those provided) by images in this config
     deps = dict()
     for image_name,image_config in images_config.items():
         req = set()
@@ -202,22 +602,172 @@ def resolve_dep_order(images_config):
         if container_system_option_names.isdisjoint(image_config.keys()):
             from_name = image_config["from"].split(":", 1)[0]
             if from_name in provided_images:
-                req.add(from_name)
+                req.add(provided_images[from_name])
         else:
             sys_config = nagoya.cli.cfg.read_one(image_config["system"])
             for cont_config in sys_config.values():
-                image_name = cont_config["image"].split(":", 1)[0]
-                if image_name in provided_images:
-                    req.add(image_name)
+                cont_image = cont_config["image"].split(":", 1)[0]
+                if cont_image in provided_images:
+                    req.add(provided_images[cont_image])
+        # A system can use an image that one of its own commits provides
+        req.discard(image_name)
+    return deps
+
+def resolve_dep_order(images_config):
+    # Figure out the images required (among those provided) by images in this config
+    deps = image_dependencies(images_config)
 
     # Toposort to sync groups, use original order of keys to order within groups
+    order = list(images_config.keys())
     image_names = []
     for group in toposort.toposort(deps):
-        image_names.extend(sorted(group, key=lambda n: images_config.keys().index(n)))
+        image_names.extend(sorted(group, key=order.index))
 
     return image_names
 
-def build_images(config, quiet, env, images=None):
+#
+# Parallel build scheduling
+#
+
+def group_dependencies(images_config, groups):
+    """
+    Returns a dict of each group's first image name to the set of other
+    groups' first image names it needs. Only images in the groups count.
+    """
+
+    deps = image_dependencies(images_config)
+    group_of = dict((image, group[0]) for group in groups for image in group)
+    group_deps = dict()
+    for group in groups:
+        reqs = set(group_of[d] for image in group for d in deps[image] if d in group_of)
+        reqs.discard(group[0])
+        group_deps[group[0]] = reqs
+    return group_deps
+
+def group_resources(images_config, groups):
+    # Containers of a system have fixed names, so systems that share container
+    # names can't run at the same time
+    resources = dict()
+    for group in groups:
+        image_config = images_config[group[0]]
+        if is_container_system(image_config):
+            sys_config = nagoya.cli.cfg.read_one(image_config["system"])
+            resources[group[0]] = set("container " + n for n in sys_config)
+    return resources
+
+BuildPlan = collections.namedtuple("BuildPlan", ["groups", "deps", "durations", "guessed", "resources", "plan"])
+
+def plan_builds(images_config, image_names, warm_systems, max_workers, history):
+    """
+    Predicts a parallel build of image_names with max_workers at once, using
+    the durations of earlier builds. Returns a BuildPlan.
+    """
+
+    groups = group_warm_systems(images_config, image_names) if warm_systems else [[n] for n in image_names]
+    deps = group_dependencies(images_config, groups)
+    resources = group_resources(images_config, groups)
+    estimates, guessed = history.estimates(image_names)
+    durations = dict((g[0], sum(estimates[n] for n in g)) for g in groups)
+    plan = nagoya.schedule.plan(deps, durations, max_workers, resources)
+    return BuildPlan(groups, deps, durations, guessed, resources, plan)
+
+def format_plan(build_plan, max_workers):
+    def fmt_duration(d):
+        return "{0:.1f}s".format(d)
+
+    plan = build_plan.plan
+    rows = [("Image", "Expected", "Chain", "Start")]
+    for group in sorted(build_plan.groups, key=lambda g: (plan.starts[g[0]], g[0])):
+        name = " + ".join(group)
+        if not build_plan.guessed.isdisjoint(group):
+            name += " *"
+        rows.append((name,
+                     fmt_duration(build_plan.durations[group[0]]),
+                     fmt_duration(plan.paths[group[0]]),
+                     fmt_duration(plan.starts[group[0]])))
+
+    widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+    lines = ["  ".join([row[0].ljust(widths[0])] + [c.rjust(w) for c, w in zip(row[1:], widths[1:])]) for row in rows]
+
+    lines.append("")
+    sequential = sum(build_plan.durations.values())
+    lines.append("Predicted makespan with {0} worker{1}: {2} (one at a time: {3})".format(max_workers, "s" if max_workers > 1 else "", fmt_duration(plan.makespan), fmt_duration(sequential)))
+    chain_length = plan.paths[plan.chain[0]] if plan.chain else 0
+    lines.append("Critical chain ({0}): {1}".format(fmt_duration(chain_length), " -> ".join(plan.chain)))
+    if build_plan.guessed:
+        lines.append("* never built, the expected duration is a guess")
+    return "\n".join(lines)
+
+def show_plan(config, images=None, warm_systems=False, max_workers=4, history_path=None):
+    if images is None:
+        images = resolve_dep_order(config)
+    history = nagoya.schedule.BuildHistory(history_path)
+    print(format_plan(plan_builds(config, images, warm_systems, max_workers, history), max_workers))
+
+#
+# Build images
+#
+
+class ImageBuilder(object):
+    """
+    Builds groups of images from one configuration, single sections or
+    warm_systems groups, possibly from several threads. Shared lib bases are
+    built once, just before the first group that needs them.
+    """
+
+    def __init__(self, config, client, quiet, env, shared_bases=dict(), history=None):
+        self.config = config
+        self.client = client
+        self.quiet = quiet
+        self.env = env
+        self.shared_bases = shared_bases
+        self.history = history
+        self.built_bases = set()
+        self.base_locks = dict((base.image, threading.Lock()) for base in shared_bases.values())
+
+    def group_key(self, group):
+        """
+        Returns a digest of everything that determines what building a group
+        produces, so identical builds requested separately can be recognised.
+        """
+
+        images = [(n, self.config[n], self.shared_bases.get(n)) for n in group]
+        data = json.dumps({"env": sorted(self.env), "images": images}, sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def build_group(self, group):
+        start = time.time()
+        if len(group) > 1:
+            build_warm_container_system(group, self.config, self.client, self.quiet, self.env)
+            for image in group:
+                finish_section(self.client, image, self.config[image])
+        else:
+            image, = group
+            logger.debug("Processing image {image}".format(**locals()))
+            image_config = self.config[image]
+
+            if is_container_system(image_config):
+                build_container_system(image, image_config, self.client, self.quiet, self.env)
+            else:
+                if image in self.shared_bases:
+                    base = self.shared_bases[image]
+                    with self.base_locks[base.image]:
+                        if not base.image in self.built_bases:
+                            # Built when first needed, the from image may come from this run
+                            build_shared_base(base, self.client, self.quiet)
+                            self.built_bases.add(base.image)
+                    image_config = rebased_config(image_config, base)
+                build_image(image, image_config, self.client, self.quiet, self.env)
+
+            finish_section(self.client, image, image_config)
+
+        if self.history is not None:
+            # The stages of a warm system share its setup, so its time is split evenly
+            duration = (time.time() - start) / len(group)
+            for image in group:
+                self.history.record(image, duration)
+
+def build_images(config, quiet, env, images=None, warm_systems=False, share_libs=False, prepull=True, pull_workers=4, max_workers=1, history=None, base_url=None):
     if images is None:
         logger.info("Resolving image dependency order")
         images = resolve_dep_order(config)
@@ -225,16 +775,32 @@ def build_images(config, quiet, env, images=None):
     num_img = len(images)
     logger.info("Building {0} image{1}".format(num_img, "s" if num_img > 1 else ""))
 
-    docker_client = docker.Client(timeout=10)
+    docker_client = docker.Client(base_url=base_url, timeout=10)
     docker_client.ping()
 
-    for image in images:
-        logger.debug("Processing image {image}".format(**locals()))
-        image_config = config[image]
+    # One image listing for the whole run, kept up to date as images are built
+    with nagoya.dockerext.image.ImageIndex(docker_client):
+        if prepull:
+            logger.info("Checking for missing base images")
+            nagoya.dockerext.image.pull_missing_images(docker_client, find_external_images(config, images), pull_workers)
 
-        if not container_system_option_names.isdisjoint(image_config.keys()):
-            build_container_system(image, image_config, docker_client, quiet, env)
+        if warm_systems:
+            groups = group_warm_systems(config, images)
+        else:
+            groups = [[image] for image in images]
+
+        shared_bases = plan_shared_bases(config, images) if share_libs else dict()
+        builder = ImageBuilder(config, docker_client, quiet, env, shared_bases, history)
+
+        if max_workers > 1 and len(groups) > 1:
+            scheduling_history = nagoya.schedule.BuildHistory() if history is None else history
+            build_plan = plan_builds(config, images, warm_systems, max_workers, scheduling_history)
+            chain = " -> ".join(build_plan.plan.chain)
+            logger.info("Building up to {max_workers} at once, predicted makespan {0:.1f}s, critical chain {chain}".format(build_plan.plan.makespan, **locals()))
+            groups_by_name = dict((g[0], g) for g in build_plan.groups)
+            nagoya.schedule.run_scheduled(build_plan.deps, build_plan.plan.paths, lambda name: builder.build_group(groups_by_name[name]), max_workers, build_plan.resources)
         else:
-            build_image(image, image_config, docker_client, quiet, env)
+            for group in groups:
+                builder.build_group(group)
 
     logger.info("Done")
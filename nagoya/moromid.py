@@ -0,0 +1,351 @@
+#
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import json
+import time
+import threading
+import itertools
+import collections
+
+import docker
+
+import nagoya.daemon
+import nagoya.moromi
+import nagoya.schedule
+import nagoya.temp
+import nagoya.dockerext.image
+import nagoya.cli.cfg
+
+logger = logging.getLogger("nagoya.moromid")
+
+# Finished jobs are kept for status requests, up to this many
+finished_jobs_kept = 100
+
+# Docker events after which the image index has to be listed again
+image_event_statuses = {"tag", "untag", "delete", "pull", "import", "load"}
+
+class Task(object):
+    """
+    One build of a group of images, shared by every job that needs an
+    identical build while it's queued or running.
+    """
+
+    def __init__(self, key, seq, group, builder, resources, path):
+        self.key = key
+        self.seq = seq
+        self.group = group
+        self.builder = builder
+        self.resources = resources
+        # Length of the longest chain of builds starting with this one
+        self.path = path
+        self.state = "queued"
+        self.error = None
+        self.start = None
+        self.end = None
+        self.jobs = set()
+        self.waiting_on = set()
+        self.dependents = set()
+
+    @property
+    def name(self):
+        return " + ".join(self.group)
+
+    def priority(self):
+        return max([j.priority for j in self.jobs if not j.finished()] or [0])
+
+    def to_dict(self):
+        return {"images": self.group,
+                "state": self.state,
+                "error": self.error,
+                "start": self.start,
+                "end": self.end,
+                "jobs": sorted(j.id for j in self.jobs)}
+
+class Job(object):
+    """
+    A build request, made of the tasks building each of its images.
+    """
+
+    def __init__(self, job_id, priority, images):
+        self.id = job_id
+        self.priority = priority
+        self.images = images
+        self.state = "pulling"
+        self.error = None
+        self.submitted = time.time()
+        self.end = None
+        self.tasks = []
+        self.done = threading.Event()
+
+    def finished(self):
+        return self.done.is_set()
+
+    def to_dict(self):
+        return {"id": self.id,
+                "priority": self.priority,
+                "images": self.images,
+                "state": self.state,
+                "error": self.error,
+                "submitted": self.submitted,
+                "end": self.end,
+                "tasks": [t.to_dict() for t in self.tasks]}
+
+class BuildService(nagoya.daemon.Server):
+    """
+    Builds images for moromi clients in a long-running process, keeping a
+    Docker client and image index warm. Queued builds start highest priority
+    first, then longest chain first, and a build identical to one that's
+    already queued or running is shared instead of repeated.
+    """
+
+    def __init__(self, socket_path, boolean_options=[], max_workers=2, history_path=None, socket_mode=0o600):
+        nagoya.daemon.Server.__init__(self, socket_path, socket_mode)
+        self.boolean_options = boolean_options
+        self.max_workers = max_workers
+        self.client = docker.Client(timeout=10)
+        self.client.ping()
+        self.index = nagoya.dockerext.image.ImageIndex(self.client)
+        self.history = nagoya.schedule.BuildHistory(history_path)
+        # Guards the jobs and tasks, workers wait on it for ready tasks
+        self.cond = threading.Condition()
+        self.jobs = collections.OrderedDict()
+        self.job_ids = itertools.count(1)
+        self.task_seqs = itertools.count()
+        # key -> Task of every queued or running task
+        self.inflight = dict()
+        self.held = set()
+
+    #
+    # Scheduling
+    #
+
+    def _next_task(self):
+        ready = [t for t in self.inflight.values()
+                 if t.state == "queued" and len(t.waiting_on) == 0 and self.held.isdisjoint(t.resources)]
+        if len(ready) == 0:
+            return None
+        return max(ready, key=lambda t: (t.priority(), t.path, -t.seq))
+
+    def _work(self):
+        while True:
+            with self.cond:
+                task = self._next_task()
+                while task is None:
+                    self.cond.wait()
+                    task = self._next_task()
+                task.state = "running"
+                task.start = time.time()
+                self.held.update(task.resources)
+                for job in task.jobs:
+                    if job.state == "queued":
+                        job.state = "running"
+
+            logger.info("Building {0} for job(s) {1}".format(task.name, ", ".join(str(j.id) for j in sorted(task.jobs, key=lambda j: j.id))))
+            error = None
+            try:
+                task.builder.build_group(task.group)
+            except Exception as e:
+                logger.error("Building {0} failed: {e}".format(task.name, **locals()))
+                error = str(e)
+
+            with self.cond:
+                task.end = time.time()
+                self.held.difference_update(task.resources)
+                self._finish_task(task, "done" if error is None else "failed", error)
+                self.cond.notify_all()
+            if error is None:
+                self.history.save()
+
+    def _release(self, task):
+        self.inflight.pop(task.key, None)
+        # Dependents still needed were also requested without this task
+        for dependent in task.dependents:
+            dependent.waiting_on.discard(task)
+
+    def _finish_task(self, task, state, error=None):
+        task.state = state
+        task.error = error
+        self._release(task)
+        for job in task.jobs:
+            if job.finished():
+                continue
+            if state == "failed":
+                self._end_job(job, "failed", "Building {0} failed: {1}".format(task.name, error))
+            elif all(t.state == "done" for t in job.tasks):
+                self._end_job(job, "done")
+
+    def _end_job(self, job, state, error=None):
+        job.state = state
+        job.error = error
+        job.end = time.time()
+        job.done.set()
+        logger.info("Job {job.id} {state}".format(**locals()))
+
+        # Queued tasks no other job needs are dropped, running ones finish
+        for task in job.tasks:
+            if task.state == "queued" and all(j.finished() for j in task.jobs):
+                task.state = "cancelled"
+                self._release(task)
+
+        finished = [j for j in self.jobs.values() if j.finished()]
+        for old in finished[:max(0, len(finished) - finished_jobs_kept)]:
+            del self.jobs[old.id]
+
+    @staticmethod
+    def _waits_on(task, other):
+        pending = [task]
+        seen = set()
+        while len(pending) > 0:
+            current = pending.pop()
+            if current is other:
+                return True
+            seen.add(current)
+            pending.extend(t for t in current.waiting_on if not t in seen)
+        return False
+
+    def _prepare(self, job, config, build_plan, builder, prepull):
+        try:
+            if prepull:
+                external = nagoya.moromi.find_external_images(config, job.images)
+                nagoya.dockerext.image.pull_missing_images(self.client, external)
+        except Exception as e:
+            with self.cond:
+                if not job.finished():
+                    self._end_job(job, "failed", str(e))
+            return
+
+        with self.cond:
+            if job.finished():
+                return
+
+            tasks = collections.OrderedDict()
+            for group in build_plan.groups:
+                name = group[0]
+                key = builder.group_key(group)
+                task = self.inflight.get(key)
+                if task is None:
+                    task = Task(key, next(self.task_seqs), group, builder, build_plan.resources.get(name, set()), build_plan.plan.paths[name])
+                    self.inflight[key] = task
+                else:
+                    logger.info("Job {0} shares the {1} build of job(s) {2}".format(job.id, task.name, ", ".join(str(j.id) for j in task.jobs)))
+                task.jobs.add(job)
+                tasks[name] = task
+
+            for name, reqs in build_plan.deps.items():
+                task = tasks[name]
+                for req in reqs:
+                    req_task = tasks[req]
+                    # Shared tasks may already be running, or depend the other way in another job's config
+                    if task.state == "queued" and req_task.state in ("queued", "running") and not self._waits_on(req_task, task):
+                        task.waiting_on.add(req_task)
+                        req_task.dependents.add(task)
+
+            job.tasks = list(tasks.values())
+            if len(job.tasks) == 0:
+                self._end_job(job, "done")
+            else:
+                job.state = "running" if any(t.state == "running" for t in job.tasks) else "queued"
+            self.cond.notify_all()
+
+    def _watch_events(self):
+        while True:
+            try:
+                # Separate client without a timeout, the stream can be idle for a long time
+                events_client = docker.Client(timeout=None)
+                logger.debug("Subscribed to Docker events")
+                for event in events_client.events():
+                    if not isinstance(event, dict):
+                        event = json.loads(event)
+                    if event.get("status") in image_event_statuses:
+                        self.index.invalidate()
+            except Exception as e:
+                logger.warn("Docker event subscription failed: {e}".format(**locals()))
+            # Changes can't be seen while resubscribing
+            self.index.invalidate()
+            time.sleep(1)
+
+    #
+    # Requests
+    #
+
+    def _job(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise KeyError("No job {0}".format(job_id))
+        return job
+
+    def rq_submit(self, config, images=None, env=[], warm_systems=False, share_libs=False, quiet=False, prepull=True, priority=0):
+        d, successful_paths = nagoya.cli.cfg.read_config(config, config, self.boolean_options)
+        nagoya.cli.cfg.add_cfg_dirs_to_path(successful_paths)
+        if images is None:
+            images = nagoya.moromi.resolve_dep_order(d)
+        unknown = [i for i in images if not i in d]
+        if len(unknown) > 0:
+            raise KeyError("No sections for {0} in {1}".format(", ".join(unknown), ", ".join(config)))
+
+        build_plan = nagoya.moromi.plan_builds(d, images, warm_systems, self.max_workers, self.history)
+        shared_bases = nagoya.moromi.plan_shared_bases(d, images) if share_libs else dict()
+        builder = nagoya.moromi.ImageBuilder(d, self.client, quiet, env, shared_bases, self.history)
+
+        with self.cond:
+            job = Job(next(self.job_ids), priority, images)
+            self.jobs[job.id] = job
+        logger.info("Job {0} submitted with priority {1}: {2}".format(job.id, priority, ", ".join(images)))
+
+        preparer = threading.Thread(target=self._prepare, args=(job, d, build_plan, builder, prepull), name="job-{0}".format(job.id))
+        preparer.daemon = True
+        preparer.start()
+        return job.id
+
+    def rq_status(self, job=None):
+        with self.cond:
+            jobs = self.jobs.values() if job is None else [self._job(job)]
+            return [j.to_dict() for j in jobs]
+
+    def rq_wait(self, job, timeout=None):
+        """
+        Returns the job once it has finished, or after timeout seconds.
+        """
+
+        with self.cond:
+            found = self._job(job)
+        found.done.wait(timeout)
+        with self.cond:
+            return found.to_dict()
+
+    def rq_cancel(self, job):
+        with self.cond:
+            found = self._job(job)
+            if not found.finished():
+                self._end_job(found, "cancelled")
+                self.cond.notify_all()
+            return found.to_dict()
+
+    def serve(self):
+        watcher = threading.Thread(target=self._watch_events, name="events")
+        watcher.daemon = True
+        watcher.start()
+
+        # Temporary directories and the index are shared by every build
+        with nagoya.temp.TempArena():
+            with self.index:
+                for i in range(max(1, self.max_workers)):
+                    worker = threading.Thread(target=self._work, name="worker-{0}".format(i))
+                    worker.daemon = True
+                    worker.start()
+                nagoya.daemon.Server.serve(self)
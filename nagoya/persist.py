@@ -0,0 +1,281 @@
+#
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Persisting container volumes into images through the archive API, with a
+# manifest of the persisted files kept in the image for later delta persists
+
+import logging
+import io
+import copy
+import os
+import json
+import shutil
+import hashlib
+import posixpath
+import tarfile
+
+import docker
+
+import nagoya.temp
+import nagoya.dockerext.archive
+import nagoya.dockerext.build
+import nagoya.dockerext.container
+import nagoya.dockerext.image
+
+logger = logging.getLogger("nagoya.build")
+
+# Where the manifest is kept in persisted images
+manifest_path = ".nagoya-persist/manifest.json"
+
+copy_buffer_size = 1024 * 1024
+
+# Modification time of every entry in reproducible archives
+reproducible_mtime = 0
+
+# Deltas stacked on one full persist before persisting everything again,
+# well below the layer depth Docker allows
+max_delta_depth = 32
+
+#
+# Volume contents
+#
+
+def _entry_type(member):
+    if member.isfile():
+        return "file"
+    elif member.isdir():
+        return "dir"
+    elif member.issym():
+        return "symlink"
+    elif member.islnk():
+        return "link"
+    else:
+        return "other"
+
+class VolumeContents(object):
+    """
+    The files in a container's volumes, read from the archive endpoint. File
+    data is spooled into a temporary directory and hashed on the way.
+    """
+
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+        # name -> (TarInfo, spool path or None)
+        self.members = dict()
+        # name -> manifest entry
+        self.manifest = dict()
+
+    def _spool(self, fileobj):
+        path = os.path.join(self.spool_dir, str(len(self.members)))
+        digest = hashlib.sha256()
+        with open(path, "wb") as f:
+            for chunk in iter(lambda: fileobj.read(copy_buffer_size), b""):
+                digest.update(chunk)
+                f.write(chunk)
+        return path, digest.hexdigest()
+
+    def read(self, client, container_name, volume_path):
+        volume_name = volume_path.strip("/")
+        raw = nagoya.dockerext.archive.get_archive(client, container_name, volume_path)
+        with tarfile.open(fileobj=raw, mode="r|") as tar:
+            for member in tar:
+                # The archive is rooted at the volume directory's basename
+                rel = member.name.partition("/")[2]
+                name = posixpath.join(volume_name, rel) if rel else volume_name
+                name = name.rstrip("/")
+                if member.islnk():
+                    link_rel = member.linkname.partition("/")[2]
+                    member.linkname = posixpath.join(volume_name, link_rel)
+
+                spool_path = None
+                sha256 = None
+                if member.isfile():
+                    spool_path, sha256 = self._spool(tar.extractfile(member))
+
+                member.name = name
+                self.members[name] = (member, spool_path)
+                self.manifest[name] = {"type": _entry_type(member),
+                                       "size": member.size,
+                                       "mtime": member.mtime,
+                                       "sha256": sha256,
+                                       "mode": member.mode,
+                                       "uid": member.uid,
+                                       "gid": member.gid,
+                                       "linkname": member.linkname}
+
+    @staticmethod
+    def _same(entry, other):
+        # Modification times alone don't make a file changed
+        keys = ["type", "size", "sha256", "mode", "uid", "gid", "linkname"]
+        return all(entry.get(k) == other.get(k) for k in keys)
+
+    def diff(self, old_manifest):
+        """
+        Returns (changed names, deleted names) compared to an older manifest.
+        """
+
+        changed = [n for n, e in self.manifest.items() if not n in old_manifest or not self._same(e, old_manifest[n])]
+        deleted = [n for n in old_manifest if not n in self.manifest]
+        return changed, deleted
+
+    def write_archive(self, fileobj, names, manifest_data, reproducible=False):
+        """
+        Write the given members and the manifest as a tar archive. Hard links to
+        files that aren't in the archive are written as copies. Reproducible
+        archives depend only on the names, contents, modes and numeric
+        ownership of the files.
+        """
+
+        def normalize(member):
+            if reproducible:
+                member = copy.copy(member)
+                member.mtime = reproducible_mtime
+                member.uname = ""
+                member.gname = ""
+                # Drops atime, ctime and sub-second times, tarfile adds back what long names need
+                member.pax_headers = dict()
+            return member
+
+        included = set(names)
+        # Explicit format, since the default differs between Python versions
+        with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+            for name in sorted(names):
+                member, spool_path = self.members[name]
+                if member.islnk() and not member.linkname in included:
+                    target, spool_path = self.members[member.linkname]
+                    copied = tarfile.TarInfo(name)
+                    for attr in ["size", "mtime", "mode", "uid", "gid", "uname", "gname"]:
+                        setattr(copied, attr, getattr(target, attr))
+                    member = copied
+                if spool_path is None:
+                    tar.addfile(normalize(member))
+                else:
+                    with open(spool_path, "rb") as f:
+                        tar.addfile(normalize(member), f)
+
+            manifest_dir = tarfile.TarInfo(posixpath.dirname(manifest_path))
+            manifest_dir.type = tarfile.DIRTYPE
+            manifest_dir.mode = 0o755
+            tar.addfile(manifest_dir)
+
+            data = json.dumps(manifest_data, sort_keys=True).encode("utf-8")
+            info = tarfile.TarInfo(manifest_path)
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+
+#
+# Manifests
+#
+
+def read_image_manifest(client, image):
+    """
+    Returns the persist manifest stored in an image, or None if it has none.
+    """
+
+    if not nagoya.dockerext.image.image_exists(client, image):
+        return None
+
+    config = client.inspect_image(image)["Config"] or dict()
+    with nagoya.dockerext.container.TempContainer(image, remove_volumes=True) as container:
+        container.client = client
+        # Never started, only needs a command if the image has neither
+        container.commands = [] if config.get("Entrypoint") or config.get("Cmd") else ["/bin/true"]
+        container.create()
+        try:
+            raw = nagoya.dockerext.archive.get_archive(client, container.name, "/" + manifest_path)
+        except docker.errors.APIError as e:
+            if e.response.status_code == 404:
+                return None
+            raise
+        with tarfile.open(fileobj=raw, mode="r|") as tar:
+            for member in tar:
+                if member.isfile():
+                    return json.loads(tar.extractfile(member).read().decode("utf-8"))
+    return None
+
+#
+# Persisting
+#
+
+def persist_container(client, container, image, quiet, delta=False, reproducible=False, compression="none", compression_level=None):
+    """
+    Build image from the container's image with the contents of its volumes
+    added, and a manifest of them. With delta, if image already exists and was
+    persisted from the same base image, the new image is built on it with only
+    the files that changed, or left as it is if none did. After
+    max_delta_depth deltas, everything is persisted again. With reproducible, identical volume contents give
+    an identical archive, so the build is a cache hit. The archive is
+    compressed as it's written if compression is gzip or xz, which ADD extracts.
+    """
+
+    logger.info("Persisting {container} container to image {image}".format(**locals()))
+
+    base_id = client.inspect_image(container.image)["Id"]
+    volume_paths = sorted(client.inspect_container(container=container.name)["Volumes"].keys())
+
+    with nagoya.temp.TempDirectory() as tdir:
+        spool_dir = os.path.join(tdir.name, "spool")
+        os.mkdir(spool_dir)
+        contents = VolumeContents(spool_dir)
+        for volume_path in volume_paths:
+            logger.debug("Reading volume {volume_path} of {container}".format(**locals()))
+            contents.read(client, container.name, volume_path)
+
+        from_image = container.image
+        names = sorted(contents.members)
+        depth = 0
+        if delta:
+            previous = read_image_manifest(client, image)
+            if previous is None:
+                logger.info("No previous persist of {image} to compare with, persisting everything".format(**locals()))
+            elif not previous.get("base") == base_id:
+                logger.info("Previous persist of {image} has a different base, persisting everything".format(**locals()))
+            elif previous.get("depth", 0) >= max_delta_depth:
+                logger.info("Previous persist of {image} has {max_delta_depth} deltas on it, persisting everything".format(**locals()))
+            else:
+                changed, deleted = contents.diff(previous["entries"])
+                if len(deleted) > 0:
+                    # Deletions can't be expressed by adding an archive, and
+                    # changes under volumes in RUN instructions are discarded
+                    logger.info("{0} file(s) were deleted since the previous persist of {image}, persisting everything".format(len(deleted), **locals()))
+                elif len(changed) == 0:
+                    # Another layer would only hold the manifest
+                    logger.info("No files changed since the previous persist of {image}, keeping it".format(**locals()))
+                    return
+                else:
+                    logger.info("Persisting {0} changed file(s) of {1} on top of the previous {image}".format(len(changed), len(names), **locals()))
+                    from_image = client.inspect_image(image)["Id"]
+                    names = sorted(changed)
+                    depth = previous.get("depth", 0) + 1
+
+        entries = contents.manifest
+        if reproducible:
+            entries = dict((n, dict(e, mtime=reproducible_mtime)) for n, e in entries.items())
+        manifest_data = {"base": base_id, "depth": depth, "entries": entries}
+        tar_name = "extract.tar" + nagoya.dockerext.archive.compression_suffixes[compression]
+        host_tar_path = os.path.join(tdir.name, tar_name)
+        with open(host_tar_path, "wb") as f:
+            with nagoya.dockerext.archive.open_compressed(f, compression, compression_level) as out:
+                contents.write_archive(out, names, manifest_data, reproducible)
+        shutil.rmtree(spool_dir)
+        size = nagoya.dockerext.image.format_bytes(os.path.getsize(host_tar_path))
+        logger.debug("Persist archive {tar_name} is {size}".format(**locals()))
+
+        logger.info("Building image {image} with volume data from {container} container".format(**locals()))
+        with nagoya.dockerext.build.BuildContext(image, from_image, client, quiet) as context:
+            context.include(host_tar_path, "/", context_rel_path=tar_name)
@@ -0,0 +1,270 @@
+#
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import os
+import errno
+import json
+import tempfile
+import threading
+import collections
+import concurrent.futures as futures
+
+logger = logging.getLogger("nagoya.schedule")
+
+#
+# Build history
+#
+
+# Images that were never built are assumed to take this long, in seconds
+default_duration = 60.0
+
+# Number of recent durations kept for each image
+history_length = 5
+
+def default_history_path():
+    cache_dir = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_dir, "nagoya", "build-history.json")
+
+def _median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2 == 1:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+class BuildHistory(object):
+    """
+    Durations of the most recent successful builds of each image, kept in a
+    JSON file. An image's expected duration is the median of its recent
+    builds, so one unusually slow or cached build doesn't skew it.
+    """
+
+    def __init__(self, path=None):
+        self.path = default_history_path() if path is None else path
+        self.durations = self._load()
+        # Durations recorded by this run, merged into the file when saving
+        self.recorded = dict()
+        self.lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f).get("durations", dict())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            logger.warn("Ignoring unreadable build history {0}".format(self.path))
+        return dict()
+
+    def record(self, image_name, duration):
+        with self.lock:
+            self.recorded.setdefault(image_name, []).append(duration)
+            self.durations[image_name] = (self.durations.get(image_name, []) + [duration])[-history_length:]
+
+    def estimate(self, image_name):
+        """
+        Returns the expected duration of an image's build, or None if it was
+        never built.
+        """
+
+        recent = self.durations.get(image_name)
+        return _median(recent) if recent else None
+
+    def estimates(self, image_names):
+        """
+        Returns (dict of image name to expected duration, set of names that
+        were guessed). Images without history are assumed to take as long as
+        the median known image, or default_duration if none are known.
+        """
+
+        known = dict((n, self.estimate(n)) for n in image_names)
+        guessed = set(n for n, d in known.items() if d is None)
+        known_durations = [d for d in known.values() if d is not None]
+        guess = _median(known_durations) if known_durations else default_duration
+        return dict((n, guess if d is None else d) for n, d in known.items()), guessed
+
+    def save(self):
+        with self.lock:
+            if len(self.recorded) == 0:
+                return
+            # Merge with the file as it is now, another run may have saved since
+            durations = self._load()
+            for image_name, recorded in self.recorded.items():
+                durations[image_name] = (durations.get(image_name, []) + recorded)[-history_length:]
+
+            history_dir = os.path.dirname(self.path)
+            if not os.path.exists(history_dir):
+                os.makedirs(history_dir)
+            # Replaced atomically, so concurrent runs never read half a file
+            fd, temp_path = tempfile.mkstemp(".tmp", ".build-history-", history_dir)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"durations": durations}, f, indent=2, sort_keys=True)
+            os.rename(temp_path, self.path)
+            logger.debug("Saved build durations of {0} images to {1}".format(len(self.recorded), self.path))
+            self.durations = durations
+            self.recorded = dict()
+
+#
+# Critical paths
+#
+
+def _dependents(deps):
+    dependents = dict((n, set()) for n in deps)
+    for name, reqs in deps.items():
+        for req in reqs:
+            dependents[req].add(name)
+    return dependents
+
+def _topological_order(deps):
+    remaining = dict((n, len(reqs)) for n, reqs in deps.items())
+    dependents = _dependents(deps)
+    order = [n for n, count in remaining.items() if count == 0]
+    for name in order:
+        for dependent in dependents[name]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                order.append(dependent)
+    if len(order) < len(deps):
+        raise ValueError("Circular dependencies between {0}".format(", ".join(sorted(n for n, c in remaining.items() if c > 0))))
+    return order
+
+def critical_paths(deps, durations):
+    """
+    Returns a dict of each name in deps to the length of the longest chain of
+    builds starting with it, including its own duration. deps maps each name
+    to the set of names it requires, all of which must be keys of deps.
+    """
+
+    dependents = _dependents(deps)
+    paths = dict()
+    for name in reversed(_topological_order(deps)):
+        paths[name] = durations[name] + max([paths[d] for d in dependents[name]] or [0])
+    return paths
+
+def critical_chain(deps, paths):
+    """
+    Returns the names on the longest chain of builds, first to last. No run
+    can finish sooner than the sum of their durations.
+    """
+
+    dependents = _dependents(deps)
+    chain = []
+    candidates = [n for n in deps if len(deps[n]) == 0]
+    while len(candidates) > 0:
+        name = max(sorted(candidates), key=lambda n: paths[n])
+        chain.append(name)
+        candidates = dependents[name]
+    return chain
+
+def _next_ready(ready, priorities, order, held, resources):
+    # Longest remaining chain first, skipping names whose resources are in use
+    for name in sorted(ready, key=lambda n: (-priorities[n], order[n])):
+        if held.isdisjoint(resources.get(name, ())):
+            return name
+    return None
+
+Plan = collections.namedtuple("Plan", ["makespan", "starts", "paths", "chain"])
+
+def plan(deps, durations, max_workers, resources=dict()):
+    """
+    Simulates building with max_workers at once, scheduled like
+    run_scheduled, and returns a Plan with the predicted makespan and start
+    times.
+    """
+
+    paths = critical_paths(deps, durations)
+    order = dict((n, i) for i, n in enumerate(sorted(deps)))
+    remaining = dict((n, len(reqs)) for n, reqs in deps.items())
+    dependents = _dependents(deps)
+    ready = set(n for n, count in remaining.items() if count == 0)
+    # (end time, name) of the running builds
+    running = []
+    held = set()
+    starts = dict()
+    now = 0.0
+
+    while len(ready) > 0 or len(running) > 0:
+        while len(running) < max_workers:
+            name = _next_ready(ready, paths, order, held, resources)
+            if name is None:
+                break
+            ready.remove(name)
+            held.update(resources.get(name, ()))
+            starts[name] = now
+            running.append((now + durations[name], name))
+
+        running.sort()
+        now, finished = running.pop(0)
+        held.difference_update(resources.get(finished, ()))
+        for dependent in dependents[finished]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.add(dependent)
+
+    return Plan(now, starts, paths, critical_chain(deps, paths))
+
+#
+# Running
+#
+
+def run_scheduled(deps, priorities, func, max_workers, resources=dict()):
+    """
+    Call func(name) for each name in deps concurrently, each after the names
+    it requires have finished. Whenever a worker is free, the ready name with
+    the highest priority is started, unless it shares a resource with a
+    running call. If a call raises, no more are started, and the first
+    exception is raised once the running calls have finished.
+    """
+
+    order = dict((n, i) for i, n in enumerate(sorted(deps)))
+    remaining = dict((n, len(reqs)) for n, reqs in deps.items())
+    dependents = _dependents(deps)
+    ready = set(n for n, count in remaining.items() if count == 0)
+    running = dict()
+    held = set()
+    failure = None
+
+    with futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        while True:
+            while failure is None and len(running) < max_workers:
+                name = _next_ready(ready, priorities, order, held, resources)
+                if name is None:
+                    break
+                ready.remove(name)
+                held.update(resources.get(name, ()))
+                running[pool.submit(func, name)] = name
+
+            if len(running) == 0:
+                break
+
+            done, _ = futures.wait(list(running), return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                held.difference_update(resources.get(name, ()))
+                if future.exception() is not None:
+                    if failure is None:
+                        failure = future
+                    continue
+                for dependent in dependents[name]:
+                    remaining[dependent] -= 1
+                    if remaining[dependent] == 0:
+                        ready.add(dependent)
+
+    if failure is not None:
+        failure.result()
@@ -20,9 +20,176 @@ import shutil
 import logging
 import os
 import stat
+import errno
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 logger = logging.getLogger("nagoya.temp")
 
+#
+# Copy methods
+#
+
+# Used by TempDirectory instances that aren't given a dir/copy_method
+default_dir = None
+default_copy_method = "copy"
+
+# ioctl from linux/fs.h, shares the source file's extents (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Errors that mean a method can't work between these filesystems, rather than a problem with the file
+unsupported_errnos = {errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOTTY,
+                      getattr(errno, "EOPNOTSUPP", errno.EINVAL), getattr(errno, "ENOTSUP", errno.EINVAL)}
+
+def _hardlink(source_path, dest_path):
+    os.link(source_path, dest_path)
+
+def _reflink(source_path, dest_path):
+    import fcntl
+    with open(source_path, "rb") as src:
+        with open(dest_path, "wb") as dest:
+            try:
+                fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+            except Exception:
+                dest.close()
+                os.remove(dest_path)
+                raise
+    shutil.copymode(source_path, dest_path)
+
+def _copy(source_path, dest_path):
+    shutil.copy2(source_path, dest_path)
+
+copy_methods = {"copy": ["copy"],
+                "hardlink": ["hardlink", "copy"],
+                "reflink": ["reflink", "copy"],
+                "auto": ["reflink", "hardlink", "copy"]}
+
+copy_functions = {"copy": _copy,
+                  "hardlink": _hardlink,
+                  "reflink": _reflink}
+
+#
+# Arena
+#
+
+arena_prefix = "nagoya-arena-"
+arena_lock_name = "arena.lock"
+arena_trash_name = "trash"
+
+# The arena TempDirectory instances are created in, if they aren't given a dir
+active_arena = None
+
+def _lock(fd):
+    import fcntl
+    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+class TempArena(object):
+    """
+    One directory per run, holding all of the run's temporary directories. It
+    contains a lock file with the PID, locked while the run is alive, so
+    directories left by killed runs can be found by sweep. Temporary
+    directories are moved aside and deleted by a background thread. Use with
+    "with ... as" blocks.
+    """
+
+    def __init__(self, dir=None):
+        base_dir = default_dir if dir is None else dir
+        self.name = tempfile.mkdtemp("", "{0}{1}-".format(arena_prefix, os.getpid()), base_dir)
+        self.trash_dir = os.path.join(self.name, arena_trash_name)
+        os.mkdir(self.trash_dir)
+
+        self.lock_file = open(os.path.join(self.name, arena_lock_name), "w")
+        _lock(self.lock_file.fileno())
+        self.lock_file.write("{0}\n".format(os.getpid()))
+        self.lock_file.flush()
+
+        self.queue = queue.Queue()
+        self.remover = threading.Thread(target=self._remove_queued, name="temp-cleanup")
+        self.remover.daemon = True
+        self.remover.start()
+        logger.debug("Created temp arena {0}".format(self.name))
+
+    def _remove_queued(self):
+        while True:
+            path = self.queue.get()
+            try:
+                if path is None:
+                    return
+                shutil.rmtree(path, ignore_errors=True)
+            finally:
+                self.queue.task_done()
+
+    def discard(self, path):
+        # Renaming is quick, so the caller doesn't wait for the tree to be deleted
+        trash_path = os.path.join(self.trash_dir, os.path.basename(path))
+        os.rename(path, trash_path)
+        self.queue.put(trash_path)
+
+    def close(self):
+        global active_arena
+        if active_arena is self:
+            active_arena = None
+        logger.debug("Waiting for temp arena {0} cleanup".format(self.name))
+        self.queue.put(None)
+        self.remover.join()
+        shutil.rmtree(self.name, ignore_errors=True)
+        self.lock_file.close()
+
+    def __enter__(self):
+        global active_arena
+        active_arena = self
+        return self
+
+    def __exit__(self, exc, value, tb):
+        self.close()
+
+def sweep(dirs=None):
+    """
+    Delete arenas left by runs that are no longer alive. Returns the deleted
+    paths.
+    """
+
+    if dirs is None:
+        dirs = set([tempfile.gettempdir()] + ([default_dir] if default_dir is not None else []))
+
+    swept = []
+    for base_dir in dirs:
+        for name in os.listdir(base_dir):
+            path = os.path.join(base_dir, name)
+            if not name.startswith(arena_prefix) or not os.path.isdir(path):
+                continue
+            lock_path = os.path.join(path, arena_lock_name)
+            try:
+                fd = os.open(lock_path, os.O_RDWR)
+            except OSError as e:
+                # Killed before the lock file was created, use the PID in the name
+                try:
+                    pid = int(name[len(arena_prefix):].split("-", 1)[0])
+                except ValueError:
+                    continue
+                try:
+                    os.kill(pid, 0)
+                    continue
+                except OSError as e:
+                    if not e.errno == errno.ESRCH:
+                        continue
+            else:
+                try:
+                    _lock(fd)
+                except (IOError, OSError):
+                    logger.debug("Temp arena {path} is in use".format(**locals()))
+                    continue
+                finally:
+                    os.close(fd)
+
+            logger.info("Removing temp arena {path} left by a dead run".format(**locals()))
+            shutil.rmtree(path, ignore_errors=True)
+            swept.append(path)
+    return swept
+
 class RelativePathError(Exception):
     pass
 
@@ -32,12 +199,25 @@ class FileTypeError(Exception):
 class TempDirectory(object):
     """
     Something roughly similar to Python 3's tempfile.TemporaryDirectory, plus
-    an include method for files and directories.
+    an include method for files and directories. Directories that containers
+    can write to should disallow hardlinks, since writing to a linked file
+    changes the source too.
     """
 
-    def __init__(self, suffix="", prefix=tempfile.template, dir=None):
+    def __init__(self, suffix="", prefix=tempfile.template, dir=None, copy_method=None, allow_hardlinks=True):
         self._closed = False
+        self.allow_hardlinks = allow_hardlinks
         self.name = None
+        self.copy_method = default_copy_method if copy_method is None else copy_method
+        if not self.copy_method in copy_methods:
+            raise ValueError("Copy method '{0}' is not one of {1}".format(self.copy_method, ", ".join(sorted(copy_methods))))
+        # Methods that failed because the filesystems don't support them
+        self._unsupported = set()
+        self._arena = active_arena if dir is None else None
+        if self._arena is not None:
+            dir = self._arena.name
+        elif dir is None:
+            dir = default_dir
         self.name = tempfile.mkdtemp(suffix, prefix, dir)
 
     def __repr__(self):
@@ -49,7 +229,10 @@ class TempDirectory(object):
 
     def cleanup(self):
         if self.name is not None and not self._closed:
-            shutil.rmtree(self.name)
+            if self._arena is not None:
+                self._arena.discard(self.name)
+            else:
+                shutil.rmtree(self.name)
             self._closed = True
 
     def __exit__(self, exc, value, tb):
@@ -70,11 +253,15 @@ class TempDirectory(object):
         if os.path.isfile(source_path):
             logger.debug("Resource {source_path} is a file".format(**locals()))
             make_parents(temp_abs_path)
-            shutil.copyfile(source_path, temp_abs_path)
+            # Changing the mode of a linked file would change the source too
+            self._copy_file(source_path, temp_abs_path, allow_shared=not executable)
         elif os.path.isdir(source_path):
             logger.debug("Resource {source_path} is a directory".format(**locals()))
             make_parents(temp_abs_path)
-            shutil.copytree(source_path, temp_abs_path)
+            if self.copy_method == "copy" or (self.copy_method == "hardlink" and not self.allow_hardlinks):
+                shutil.copytree(source_path, temp_abs_path)
+            else:
+                self._copy_tree(source_path, temp_abs_path)
         else:
             raise FileTypeError("Resource {source_path} is not a directory or a file".format(**locals()))
 
@@ -83,3 +270,30 @@ class TempDirectory(object):
             # equiv. of chmod +x
             mode = os.stat(temp_abs_path).st_mode
             os.chmod(temp_abs_path, mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    def _copy_file(self, source_path, dest_path, allow_shared=True):
+        for method in copy_methods[self.copy_method]:
+            if method in self._unsupported or (not allow_shared and not method == "copy"):
+                continue
+            if method == "hardlink" and not self.allow_hardlinks:
+                continue
+            try:
+                copy_functions[method](source_path, dest_path)
+                return method
+            except (IOError, OSError) as e:
+                if method == "copy" or not e.errno in unsupported_errnos:
+                    raise
+                logger.debug("Copy method {method} isn't supported for {source_path}, falling back: {e}".format(**locals()))
+                self._unsupported.add(method)
+
+    def _copy_tree(self, source_dir, dest_dir):
+        # Like shutil.copytree (following symlinks), but with the copy method
+        os.makedirs(dest_dir)
+        for name in os.listdir(source_dir):
+            source_path = os.path.join(source_dir, name)
+            dest_path = os.path.join(dest_dir, name)
+            if os.path.isdir(source_path):
+                self._copy_tree(source_path, dest_path)
+            else:
+                self._copy_file(source_path, dest_path)
+        shutil.copystat(source_dir, dest_dir)
@@ -16,6 +16,7 @@
 #
 
 import logging
+import os
 import sys
 import concurrent.futures as futures
 import traceback
@@ -24,6 +25,8 @@ import docker
 import toposort
 
 import nagoya.dockerext.container
+import nagoya.dockerext.execute
+import nagoya.dockerext.image
 
 logger = logging.getLogger("nagoya.toji")
 
@@ -172,13 +175,51 @@ class Toji(object):
                             logs[cont.name] = cont.logs()
                     raise ExecutionError(exceptions, logs)
 
-    def init_containers(self):
+    def drifted_containers(self):
+        drifted = set(c.name for c in self.containers if c.drifted())
+
+        # Dependents of a recreated container need to be recreated to pick up the new one
+        changed = True
+        while changed:
+            changed = False
+            for container in self.containers:
+                if not container.name in drifted and container.dependency_names() & drifted:
+                    drifted.add(container.name)
+                    changed = True
+
+        return [c for c in self.containers if c.name in drifted]
+
+    def recreate_containers(self, containers):
+        names = set(c.name for c in containers)
+        def remove_selected(container):
+            if container.name in names:
+                container.remove()
+        self.containers_exec(remove_selected, group_ordering=reversed)
+
+    def init_containers(self, drift="ignore"):
+        if not drift in ["ignore", "warn", "recreate"]:
+            raise ValueError("Drift action '{drift}' is not valid".format(**locals()))
+
+        if not drift == "ignore":
+            drifted = self.drifted_containers()
+            if drifted:
+                names = ", ".join(c.name for c in drifted)
+                if drift == "recreate":
+                    logger.info("Recreating drifted container(s) {names}".format(**locals()))
+                    self.recreate_containers(drifted)
+                else:
+                    logger.warn("Container(s) {names} differ from their configuration and won't be recreated".format(**locals()))
+
         try:
             self.containers_exec(nagoya.dockerext.container.Container.init)
         except ExecutionError as e:
             e.show_logs = True
             raise
 
+    def pull_missing_images(self, max_workers=4):
+        images = [c.image for c in self.containers]
+        return nagoya.dockerext.image.pull_missing_images(self.client, images, max_workers)
+
     def start_containers(self):
         self.containers_exec(nagoya.dockerext.container.Container.start)
 
@@ -188,6 +229,98 @@ class Toji(object):
     def remove_containers(self):
         self.containers_exec(nagoya.dockerext.container.Container.remove, group_ordering=reversed)
 
+    def _lookup_containers(self, names=None):
+        if not names:
+            return list(self.containers)
+        by_name = dict((c.name, c) for c in self.containers)
+        missing = [n for n in names if not n in by_name]
+        if missing:
+            raise KeyError(", ".join(missing))
+        return [by_name[n] for n in names]
+
+    def exec_containers(self, command, names=None, max_workers=8, quiet=False):
+        """
+        Run a command in many running containers in parallel. Returns a list of
+        (name, exit code), with None as the exit code if the command couldn't
+        be run. Without names, runs in every running container.
+        """
+
+        if names:
+            containers = self._lookup_containers(names)
+        else:
+            containers = [c for c in self.containers if c.state() == "running"]
+        if not containers:
+            logger.warn("No running containers to execute in")
+            return []
+
+        output = None if quiet else nagoya.dockerext.execute.PrefixedOutput([c.name for c in containers])
+
+        def run(container):
+            try:
+                return nagoya.dockerext.execute.exec_container(container, command, output)
+            except Exception as e:
+                logger.error("Couldn't execute in container {container}: {e}".format(**locals()))
+                return None
+
+        with futures.ThreadPoolExecutor(max_workers=min(max_workers, len(containers))) as pool:
+            exit_codes = list(pool.map(run, containers))
+
+        results = [(c.name, code) for c, code in zip(containers, exit_codes)]
+        for name, code in results:
+            if not code == 0:
+                logger.error("Command failed in container {name} with exit code {code}".format(**locals()))
+        return results
+
+    def _parallel(self, func, items, max_workers):
+        # Modify run method to provide exc_info consistently for Python 2 and 3
+        if not futures.thread._WorkItem.run.__code__.co_code == cft_run.__code__.co_code:
+            futures.thread._WorkItem.run = cft_run
+
+        with futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as pool:
+            fs = [pool.submit(func, item) for item in items]
+            exceptions = [f.exception() for f in fs if f.exception() is not None]
+        if exceptions:
+            raise ExecutionError(exceptions, dict())
+
+    def copy_out_containers(self, sources, host_dir, max_workers=8):
+        """
+        Copy (name, container path) sources to host_dir in parallel. With more
+        than one container, each one's files go in a subdirectory named after it.
+        """
+
+        containers = self._lookup_containers(list(set(name for name, _ in sources)))
+        by_name = dict((c.name, c) for c in containers)
+        per_container = len(containers) > 1
+
+        def copy(source):
+            name, container_path = source
+            dest = os.path.join(host_dir, name) if per_container else host_dir
+            logger.info("Copying {container_path} from {name} to {dest}".format(**locals()))
+            by_name[name].copy_out(container_path, dest)
+
+        self._parallel(copy, sources, max_workers)
+
+    def copy_in_containers(self, host_paths, container_dir, names=None, max_workers=8):
+        containers = self._lookup_containers(names)
+
+        def copy(container):
+            logger.info("Copying {0} to {container_dir} in {container}".format(", ".join(host_paths), **locals()))
+            container.copy_in(host_paths, container_dir)
+
+        self._parallel(copy, containers, max_workers)
+
+    def container_states(self, names=None):
+        return [(c.name, c.state()) for c in self._lookup_containers(names)]
+
+    def container_logs(self, names=None):
+        logs = []
+        for container in self._lookup_containers(names):
+            text = container.logs()
+            if isinstance(text, bytes):
+                text = text.decode("utf-8", "replace")
+            logs.append((container.name, text))
+        return logs
+
 class TempToji(Toji):
     """
     Allows the use of "with ... as" blocks for a temporary Toji instance
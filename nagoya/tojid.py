@@ -0,0 +1,189 @@
+#
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import os
+import json
+import time
+import threading
+
+import docker
+
+import nagoya.daemon
+import nagoya.toji
+import nagoya.cli.cfg
+
+logger = logging.getLogger("nagoya.tojid")
+
+class StateCache(object):
+    """
+    Tracks the state of every container on the Docker host from the event
+    stream, so status requests don't need an inspect per container.
+    """
+
+    event_states = {"create": "created",
+                    "start": "running",
+                    "restart": "running",
+                    "unpause": "running",
+                    "pause": "paused",
+                    "die": "exited"}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.live = False
+        self.names = dict()
+        self.states = dict()
+
+    @staticmethod
+    def _status_state(status):
+        if status.startswith("Up"):
+            return "paused" if "Paused" in status else "running"
+        elif status == "":
+            return "created"
+        else:
+            return "exited"
+
+    def load(self, client):
+        names = dict()
+        states = dict()
+        for cont in client.containers(all=True):
+            # Linked containers have extra names like /koji/kojidatabase
+            name = next((n[1:] for n in cont["Names"] if n.count("/") == 1), None)
+            if name is not None:
+                names[cont["Id"]] = name
+                states[name] = self._status_state(cont["Status"])
+        with self.lock:
+            self.names = names
+            self.states = states
+
+    def update(self, client, event):
+        status = event.get("status")
+        cont_id = event.get("id")
+        if cont_id is None:
+            return
+
+        if status == "destroy":
+            with self.lock:
+                name = self.names.pop(cont_id, None)
+                if name is not None:
+                    self.states.pop(name, None)
+        elif status in self.event_states:
+            with self.lock:
+                name = self.names.get(cont_id)
+            if name is None:
+                try:
+                    name = client.inspect_container(cont_id)["Name"].lstrip("/")
+                except docker.errors.APIError as e:
+                    logger.debug("Couldn't inspect container {cont_id} from event: {e}".format(**locals()))
+                    return
+            with self.lock:
+                self.names[cont_id] = name
+                self.states[name] = self.event_states[status]
+
+    def get(self, name):
+        with self.lock:
+            if not self.live:
+                return None
+            return self.states.get(name, "missing")
+
+class TojiDaemon(nagoya.daemon.Server):
+    """
+    Keeps Docker clients, parsed configurations and container states warm, and
+    runs toji commands on behalf of thin clients.
+    """
+
+    def __init__(self, socket_path, boolean_options=[]):
+        nagoya.daemon.Server.__init__(self, socket_path)
+        self.boolean_options = boolean_options
+        self.client = docker.Client(timeout=10)
+        self.client.ping()
+        self.states = StateCache()
+        self.tojis = dict()
+        self.tojis_lock = threading.Lock()
+
+    def _watch_events(self):
+        while True:
+            try:
+                # Separate client without a timeout, the stream can be idle for a long time
+                events_client = docker.Client(timeout=None)
+                self.states.load(events_client)
+                self.states.live = True
+                logger.debug("Subscribed to Docker events")
+                for event in events_client.events():
+                    if not isinstance(event, dict):
+                        event = json.loads(event)
+                    self.states.update(self.client, event)
+            except Exception as e:
+                logger.warn("Docker event subscription failed: {e}".format(**locals()))
+            self.states.live = False
+            time.sleep(1)
+
+    def _toji(self, config):
+        key = tuple(config)
+        mtimes = [os.path.getmtime(p) if os.path.exists(p) else None for p in config]
+        with self.tojis_lock:
+            cached = self.tojis.get(key)
+            if cached is None or not cached[0] == mtimes:
+                logger.info("Loading configuration {0}".format(", ".join(config)))
+                d, successful_paths = nagoya.cli.cfg.read_config(config, config, self.boolean_options)
+                nagoya.cli.cfg.add_cfg_dirs_to_path(successful_paths)
+                # Commands against one system are serialised, like separate CLI runs would be
+                cached = (mtimes, nagoya.toji.Toji.from_dict(d, client=self.client), threading.Lock())
+                self.tojis[key] = cached
+        return cached[1], cached[2]
+
+    def rq_init(self, config, drift="warn", pull=False, jobs=4):
+        toji, lock = self._toji(config)
+        with lock:
+            if pull:
+                toji.pull_missing_images(jobs)
+            toji.init_containers(drift)
+
+    def rq_start(self, config):
+        toji, lock = self._toji(config)
+        with lock:
+            toji.start_containers()
+
+    def rq_stop(self, config):
+        toji, lock = self._toji(config)
+        with lock:
+            toji.stop_containers()
+
+    def rq_remove(self, config):
+        toji, lock = self._toji(config)
+        with lock:
+            toji.remove_containers()
+
+    def rq_status(self, config, names=None):
+        toji, _ = self._toji(config)
+        states = []
+        for container in toji._lookup_containers(names):
+            state = self.states.get(container.name)
+            if state is None:
+                state = container.state()
+            states.append((container.name, state))
+        return states
+
+    def rq_logs(self, config, names=None):
+        toji, _ = self._toji(config)
+        return toji.container_logs(names)
+
+    def serve(self):
+        watcher = threading.Thread(target=self._watch_events, name="events")
+        watcher.daemon = True
+        watcher.start()
+        nagoya.daemon.Server.serve(self)
@@ -0,0 +1,49 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import nagoya.dockerext.archive
+
+def _archive(*members):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for name, kind, value in members:
+            info = tarfile.TarInfo(name)
+            if kind == "sym":
+                info.type = tarfile.SYMTYPE
+                info.linkname = value
+                tar.addfile(info)
+            else:
+                info.size = len(value)
+                tar.addfile(info, io.BytesIO(value))
+    buf.seek(0)
+    return buf
+
+class ExtractStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.parent = tempfile.mkdtemp()
+        self.host_dir = os.path.join(self.parent, "dest")
+
+    def tearDown(self):
+        shutil.rmtree(self.parent)
+
+    def test_symlink_chain_escape(self):
+        archive = _archive(("k", "sym", "."),
+                           ("e", "sym", "k/.."),
+                           ("e/escaped", "file", b"data"))
+        nagoya.dockerext.archive.extract_stream(archive, self.host_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.parent, "escaped")))
+
+    def test_safe_members(self):
+        archive = _archive(("a/b", "file", b"data"),
+                           ("a/link", "sym", "b"))
+        extracted = nagoya.dockerext.archive.extract_stream(archive, self.host_dir)
+        self.assertEqual(extracted, ["a/b", "a/link"])
+        with open(os.path.join(self.host_dir, "a", "link"), "rb") as f:
+            self.assertEqual(f.read(), b"data")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -19,58 +19,172 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from __future__ import print_function
 import sys
 import os
+import argparse
 
 import nagoya.cli.args
 import nagoya.cli.log
 import nagoya.cli.cfg
-import nagoya.toji
+import nagoya.daemon
 
 default_config_paths = ["cfg/containers.cfg"]
 boolean_config_options = ["multiple", "detach", "run_once"]
 
-# So any local callback modules referenced in the cfg can be loaded
-def _add_cfg_dirs_to_path(cfg_paths):
-    for cfg_path in cfg_paths:
-        cfg_dir = os.path.dirname(cfg_path)
-        sys.path.append(cfg_dir)
+def _config_paths(args):
+    paths = default_config_paths if args.config == [] else args.config
+    return [os.path.abspath(os.path.expanduser(p)) for p in paths]
 
 def _config_dict(args):
     d, successful_paths = nagoya.cli.cfg.read_config(args.config, default_config_paths, boolean_config_options)
-    _add_cfg_dirs_to_path(successful_paths)
+    nagoya.cli.cfg.add_cfg_dirs_to_path(successful_paths)
     return d
 
+# Imported on demand so help output and argcomplete don't pay for docker/requests
+def _toji_from_config(args):
+    import nagoya.toji
+    return nagoya.toji.Toji.from_dict(_config_dict(args))
+
+# Returns None if the command should be run locally
+def _daemon_request(args, command, **params):
+    if args.no_daemon:
+        return None
+    client = nagoya.daemon.Client(args.socket)
+    if not client.available():
+        return None
+    return client.request(command, config=_config_paths(args), **params)
+
 def sc_init(args):
-    toji = nagoya.toji.Toji.from_dict(_config_dict(args))
-    toji.init_containers()
+    drift = "recreate" if args.recreate_drifted else "warn"
+    if _daemon_request(args, "init", drift=drift, pull=args.pull, jobs=args.jobs) is None:
+        toji = _toji_from_config(args)
+        if args.pull:
+            toji.pull_missing_images(args.jobs)
+        toji.init_containers(drift)
 
 def scargs_init(parser):
     parser.description = "Create and start the containers defined in the configuration"
+    parser.add_argument("-r", "--recreate-drifted", action="store_true", help="Recreate containers (and their dependents) whose configuration or image has changed since they were created")
+    parser.add_argument("-p", "--pull", action="store_true", help="Pull any missing images concurrently before creating the containers")
+    parser.add_argument("-j", "--jobs", type=nagoya.cli.args.positive_int, default=4, help="Number of images to pull at once")
 
 def sc_start(args):
-    toji = nagoya.toji.Toji.from_dict(_config_dict(args))
-    toji.start_containers()
+    if _daemon_request(args, "start") is None:
+        _toji_from_config(args).start_containers()
 
 def scargs_start(parser):
     parser.description = "Start the already created containers defined in the configuration"
 
 def sc_stop(args):
-    toji = nagoya.toji.Toji.from_dict(_config_dict(args))
-    toji.stop_containers()
+    if _daemon_request(args, "stop") is None:
+        _toji_from_config(args).stop_containers()
 
 def scargs_stop(parser):
     parser.description = "Stop any started containers defined in the configuration"
 
 def sc_remove(args):
-    toji = nagoya.toji.Toji.from_dict(_config_dict(args))
-    toji.remove_containers()
+    if _daemon_request(args, "remove") is None:
+        _toji_from_config(args).remove_containers()
 
 def scargs_remove(parser):
     parser.description = "Remove any created containers defined in the configuration"
 
+def sc_status(args):
+    response = _daemon_request(args, "status", names=args.names)
+    if response is None:
+        states = _toji_from_config(args).container_states(args.names)
+    else:
+        states = response["result"]
+    for name, state in states:
+        print("{0} {1}".format(name, state))
+
+def scargs_status(parser):
+    parser.description = "Show the state of the containers defined in the configuration"
+    names = parser.add_argument("names", metavar="NAME", nargs="*", help="Only show this container")
+    if nagoya.cli.args.argcomplete_available:
+        names.completer = nagoya.cli.args.ConfigSectionsCompleter(default_config_paths)
+
+def sc_logs(args):
+    response = _daemon_request(args, "logs", names=args.names)
+    if response is None:
+        logs = _toji_from_config(args).container_logs(args.names)
+    else:
+        logs = response["result"]
+    for name, text in logs:
+        if text is not None:
+            print("Logs for {0}:\n{1}".format(name, text))
+
+def scargs_logs(parser):
+    parser.description = "Show the logs of the containers defined in the configuration"
+    names = parser.add_argument("names", metavar="NAME", nargs="*", help="Only show logs for this container")
+    if nagoya.cli.args.argcomplete_available:
+        names.completer = nagoya.cli.args.ConfigSectionsCompleter(default_config_paths)
+
+def sc_exec(args):
+    if "--" in args.arguments:
+        split = args.arguments.index("--")
+        names, command = args.arguments[:split], args.arguments[split + 1:]
+    elif args.all:
+        names, command = [], args.arguments
+    else:
+        names, command = [], []
+
+    if not command or (names == []) == (not args.all):
+        print("Give either --all or container names, then -- and the command", file=sys.stderr)
+        return 2
+
+    # Always runs locally, so the output can be streamed
+    results = _toji_from_config(args).exec_containers(command, names, args.jobs, args.quiet_exec)
+    return 0 if all(code == 0 for _, code in results) else 1
+
+def scargs_exec(parser):
+    parser.description = "Execute a command in many running containers in parallel"
+    parser.add_argument("-a", "--all", action="store_true", help="Execute in all running containers defined in the configuration")
+    parser.add_argument("-j", "--jobs", type=nagoya.cli.args.positive_int, default=8, help="Maximum number of containers to execute in at once")
+    parser.add_argument("-b", "--quiet-exec", action="store_true", help="Do not print the command's stdout/stderr")
+    parser.add_argument("arguments", metavar="NAME... -- COMMAND", nargs=argparse.REMAINDER, help="Container names, then -- and the command to execute")
+
+def _split_container_spec(spec):
+    if ":" in spec:
+        return spec.split(":", 1)
+    return None, spec
+
+def sc_cp(args):
+    sources = [_split_container_spec(s) for s in args.sources]
+    dest_names, dest_path = _split_container_spec(args.dest)
+    toji = _toji_from_config(args)
+
+    if dest_names is None:
+        if any(name is None for name, _ in sources):
+            print("Sources must be NAME:PATH when copying to the host", file=sys.stderr)
+            return 2
+        toji.copy_out_containers(sources, dest_path, args.jobs)
+    else:
+        if any(name is not None for name, _ in sources):
+            print("Sources must be host paths when copying to containers", file=sys.stderr)
+            return 2
+        names = None if dest_names == "*" else dest_names.split(",")
+        toji.copy_in_containers([p for _, p in sources], dest_path, names, args.jobs)
+
+def scargs_cp(parser):
+    parser.description = "Copy files between the host and containers defined in the configuration, through the Docker archive API. Container paths are given as NAME:PATH. To copy into many containers, use NAME,NAME:DIR or *:DIR as the destination."
+    parser.add_argument("-j", "--jobs", type=nagoya.cli.args.positive_int, default=8, help="Maximum number of containers to copy to/from at once")
+    parser.add_argument("sources", metavar="SOURCE", nargs="+", help="Host path, or NAME:PATH in a container")
+    parser.add_argument("dest", metavar="DEST", help="Host directory, or NAME:DIR in containers")
+
+def sc_daemon(args):
+    import nagoya.tojid
+    server = nagoya.tojid.TojiDaemon(args.socket, boolean_config_options)
+    server.serve()
+
+def scargs_daemon(parser):
+    parser.description = "Serve toji commands from a long-running process. While it is running, other toji commands are sent to it."
+
 if __name__ == "__main__":
     parser = nagoya.cli.args.create_default_argument_parser(description="Manage Docker container systems")
+    parser.add_argument("-s", "--socket", default=nagoya.daemon.default_socket_path("toji"), help="Unix socket of the toji daemon")
+    parser.add_argument("-D", "--no-daemon", action="store_true", help="Don't send commands to a running toji daemon")
     nagoya.cli.args.add_subcommand_subparsers(parser)
     nagoya.cli.args.attempt_autocomplete(parser)
     args = parser.parse_args()